@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the page layout code in libjust and for what book.py does when it opens a book or the terminal is resized. Run it before and after changing the layout code:
+#
+#	bench.py                 Quick run on a couple of small books
+#	bench.py --sizes 5M      One Gutenberg-omnibus-sized book
+#	bench.py --golden FILE   Also check the pages against digests saved in FILE (which is created if it doesn't exist)
+#
+# The books are generated, so that the results can be compared from run to run: paragraphs of made-up sentences, either hard-wrapped at 70 columns like Gutenberg's plain-text books (which are read with --merge-lines) or with one line per paragraph, with or without indented paragraphs, and optionally with long unbreakable tokens (URLs and the like) that force hyphenation.
+# Each book is laid out at the page sizes given by a set of terminal sizes and column counts, and a failure is reported if the fast layout engine's pages aren't byte-for-byte the same as justify_words()'s. The parallel layout (parallel_page_ends()) is timed and checked too, with one process per CPU or as many as -j gives.
+# Startup is timed last: a fresh Python process opening a .txt book the way book.py does and getting its first page ready, which fails if it takes longer than --startup-budget.
+
+import argparse as ap
+import hashlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from os import path
+
+from libjust import *
+import book
+
+vocabulary = ('the of and to a in that he was it his her I with as had for she not at but be on you is him by all which they so my were this from have me said one what there their when an would or if no been we them are who could more into do will your then any up out now very man upon some little great such time like only well before about should other must than these mr did over know made our its may might can how good much down two after see never lady much where own day nothing say come old thought life long think again himself without house went many being always every away those while young every something place even though most little through own whom eyes heard hand room last yet mind first night people shall answered mrs herself father under mother friend looked cannot moment whole once each felt seemed words family sister hope nor same rather dear brother having letter among till side gentleman soon manner heart myself because indeed quite poor back half ever till evening tell sir world left').split()
+long_tokens = ('http://www.gutenberg.org/ebooks/12345.txt.utf-8', 'Honorificabilitudinitatibus', '*****************************************', 'antidisestablishmentarianism-and-then-some', '_______________________________________________________________')
+
+startup_budget_ms = 400
+startup_runs = 5	# The fastest of these is compared with the budget, as the slower ones are mostly other things on the machine getting in the way
+startup_script = '''import sys
+import book
+book.args = book.par.parse_args(sys.argv[3:])
+book.load_book()
+book.ready_text(book.text, int(sys.argv[1]), int(sys.argv[2])).pages[0]
+'''	# What book.py does up to showing the first page, without curses
+
+def make_book(size, wrapped = True, indented = False, long_words = False, seed = 1):
+	# Returns about <size> characters of generated book text (see the comments at the top of the file)
+	rand = random.Random(seed)
+	paras = []
+	length = 0
+	while length < size:
+		words = []
+		for _ in range(rand.randint(1, 8)):
+			sentence = [rand.choice(vocabulary) for _ in range(rand.randint(3, 25))]
+			sentence[0] = sentence[0].capitalize()
+			if long_words and rand.random() < 0.1:
+				sentence.insert(rand.randrange(len(sentence)), rand.choice(long_tokens))
+			words += sentence
+			words[-1] += rand.choice('.....;!?')
+		if rand.random() < 0.05:	# Chapter headings, poetry and the like: short lines
+			para = '\n'.join(' '.join(words[i:i+5]) for i in range(0, len(words), 5))
+		elif wrapped:
+			lines = []
+			line = ''
+			for word in words:
+				if line and len(line)+len(word) >= 70:
+					lines.append(line)
+					line = word
+				else:
+					line = line+' '+word if line else word
+			para = '\n'.join(lines+[line])
+		else:
+			para = ' '.join(words)
+		if indented:
+			para = '    '+para
+		paras.append(para)
+		length += len(para)+2
+	return '\n\n'.join(paras)+'\n'
+
+def page_size(x, y, cols):
+	# The page width and height book.py uses for a terminal of <x> by <y> with <cols> columns (see create_column_layout)
+	return (x-book.margin*(cols+1))//cols-1, y-book.top-book.bottom-1
+
+def use_options(merge, workers = 1):
+	# Sets book.py's command line options to those for reading a book that isn't cached, with lines merged if <merge>, in <workers> processes
+	book.args = book.par.parse_args(['--no-cache'] + ['-m']*merge + (['-j', str(workers)] if workers else []))
+
+def book_words(text, merge):
+	# Splits <text> into words the way book.py does before laying it out
+	use_options(merge)
+	return book.text_words(text)
+
+def ready_text(text, page_width, page_height, merge, workers = 1, old_layout = None):
+	# book.py's ready_text(), for a book that isn't cached: opening it, or laying it out again after a resize if <old_layout> is given
+	use_options(merge, workers)
+	if old_layout is None:
+		book.last_split = (None, None)
+	return book.ready_text(text, page_width, page_height, old_layout)
+
+def timed(f, *args, **kwargs):
+	# Returns what f returns, and how many seconds it took
+	start = time.perf_counter()
+	result = f(*args, **kwargs)
+	return result, time.perf_counter()-start
+
+def peak_memory(f, *args, **kwargs):
+	# Returns the most memory, in bytes, allocated at once while running f
+	tracemalloc.start()
+	try:
+		f(*args, **kwargs)
+		return tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+def lay_out_all(words, width, height, engine):
+	# Renders every page with <engine> (justify_words or justify_words_fast) the way the layout worker does it, returning the pages and index
+	target = WordMetrics(words) if engine is justify_words_fast else words
+	pages = []
+	index = []
+	word_n = indent = skip = 0
+	while word_n < len(words):
+		page, _, word_n, indent, skip = engine(target, width, word_n, 1, height, indent, skip)
+		pages.append(page)
+		index.append(word_n)
+	return pages, index
+
+def find_page_ends(words, width, height):
+	# Finds where every page ends with justify_words_fast() without rendering them, the way the layout worker does it, returning the index
+	metrics = WordMetrics(words)
+	index = []
+	word_n = indent = skip = 0
+	while word_n < len(words):
+		_, _, word_n, indent, skip = justify_words_fast(metrics, width, word_n, 1, height, indent, skip, render=False)
+		index.append(word_n)
+	return index
+
+def finished_layout(text, width, height, merge, workers = 1):
+	layout = ready_text(text, width, height, merge, workers)
+	layout.wait_until_done()
+	return layout
+
+def digest(pages, index):
+	h = hashlib.sha256()
+	for page, end in zip(pages, index):
+		h.update(page.encode('utf-8', 'surrogatepass'))
+		h.update(b'\0%d\0'%end)
+	return h.hexdigest()
+
+def fmt_rate(n, seconds):
+	if seconds <= 0:
+		return '-'
+	rate = n/seconds
+	for unit in ('', 'k', 'M'):
+		if rate < 1000:
+			return '%.1f%s'%(rate, unit)
+		rate /= 1000
+	return '%.1fG'%rate
+
+def fmt_bytes(n):
+	for unit in ('B', 'KB', 'MB'):
+		if n < 1024:
+			return '%.0f%s'%(n, unit)
+		n /= 1024
+	return '%.1fGB'%n
+
+def parse_size(s):
+	mult = {'k': 1000, 'm': 1000000}.get(s[-1].lower(), 1)
+	return int(float(s.rstrip('kKmM'))*mult)
+
+class Report:
+# Prints results as a table, and keeps count of failed checks
+	def __init__(self):
+		self.failures = 0
+		self.row('benchmark', 'book', 'size', 'time', 'words/s', 'pages/s', 'peak mem')
+
+	def row(self, *cols):
+		print('%-30s %-22s %-10s %9s %9s %9s %9s'%cols)
+		sys.stdout.flush()
+
+	def result(self, name, book, size, seconds, words = None, pages = None, memory = None):
+		self.row(name, book, size, '%.3fs'%seconds, fmt_rate(words, seconds) if words else '-', fmt_rate(pages, seconds) if pages else '-', fmt_bytes(memory) if memory else '-')
+
+	def fail(self, msg):
+		self.failures += 1
+		print('FAIL: '+msg)
+
+def run_book(report, name, text, merge, sizes, args, golden):
+	with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False, encoding='utf-8') as f:
+		f.write(text)
+		filename = f.name
+	try:
+		words, secs = timed(book_words, text, merge)
+		report.result('split_text_into_words', name, '', secs, len(words), memory=peak_memory(book_words, text, merge))
+		mapped, secs = timed(MappedWords, filename, merge)
+		report.result('MappedWords', name, '', secs, len(mapped), memory=peak_memory(MappedWords, filename, merge))
+		if list(mapped) != words:
+			report.fail('%s: MappedWords gives different words from split_text_into_words'%name)
+		metrics, secs = timed(WordMetrics, words)
+		report.result('WordMetrics', name, '', secs, len(words), memory=peak_memory(WordMetrics, words))
+		for x, y, cols in sizes:
+			width, height = page_size(x, y, cols)
+			geometry = '%dx%d/%d'%(x, y, cols)
+			(pages, index), secs = timed(split_words_into_pages, words, width, height, 1)
+			report.result('split_words_into_pages', name, geometry, secs, len(words), len(pages), peak_memory(split_words_into_pages, words, width, height, 1))
+			if args.jobs != 1:
+				(par_pages, par_index), secs = timed(split_words_into_pages, words, width, height, 1, workers=args.jobs)
+				report.result('split_words_into_pages -j', name, geometry, secs, len(words), len(par_pages))
+				if (par_pages, par_index) != (pages, index):
+					report.fail('%s at %s: parallel pages differ from split_words_into_pages'%(name, geometry))
+				ends, secs = timed(list, parallel_page_ends(words, width, height, 1, args.jobs))
+				report.result('parallel_page_ends', name, geometry, secs, len(words), len(ends))
+				if [end[0] for end in ends] != index:
+					report.fail('%s at %s: parallel_page_ends differs from split_words_into_pages'%(name, geometry))
+			(fast_pages, fast_index), secs = timed(lay_out_all, words, width, height, justify_words_fast)
+			report.result('justify_words_fast', name, geometry, secs, len(words), len(fast_pages))
+			ends_index, secs = timed(find_page_ends, words, width, height)
+			report.result('justify_words_fast (ends only)', name, geometry, secs, len(words), len(ends_index))
+			if ends_index != index:
+				report.fail('%s at %s: justify_words_fast page ends differ from split_words_into_pages'%(name, geometry))
+			if args.reference:
+				(ref_pages, ref_index), secs = timed(lay_out_all, words, width, height, justify_words)
+				report.result('justify_words', name, geometry, secs, len(words), len(ref_pages))
+				if (ref_pages, ref_index) != (fast_pages, fast_index) or (ref_pages, ref_index) != (pages, index):
+					report.fail('%s at %s: justify_words_fast pages differ from justify_words'%(name, geometry))
+			layout, secs = timed(finished_layout, text, width, height, merge)
+			report.result('ready_text', name, geometry, secs, len(words), layout.laid_out(), peak_memory(finished_layout, text, width, height, merge))
+			if list(layout.pages) != pages or list(layout.index) != index:
+				report.fail('%s at %s: PageLayout pages differ from split_words_into_pages'%(name, geometry))
+			layout, secs = timed(finished_layout, mapped, width, height, merge)
+			report.result('ready_text (mapped)', name, geometry, secs, len(words), layout.laid_out())
+			if list(layout.index) != index or layout.pages[len(index)//2] != pages[len(index)//2]:
+				report.fail('%s at %s: MappedWords layout differs'%(name, geometry))
+			key = '%s %s'%(name, geometry)
+			if golden is not None:
+				d = digest(pages, index)
+				if golden.setdefault(key, d) != d:
+					report.fail('%s at %s: pages differ from the golden digest'%(name, geometry))
+		run_resizes(report, name, text, merge, sizes)
+		if args.jobs != 1:
+			run_resizes(report, name, text, merge, sizes, args.jobs)
+	finally:
+		os.remove(filename)
+
+def run_resizes(report, name, text, merge, sizes, workers = 1):
+	# Simulates reading a way into the book and then resizing the terminal through each of <sizes>, timing how long until the page holding the reading position can be shown and until the whole book has been laid out again, with the layouts done in <workers> processes
+	suffix = ' -j' if workers != 1 else ''
+	layout = ready_text(text, *page_size(*sizes[0]), merge, workers)
+	layout.wait_until_done()
+	word = layout.index[layout.laid_out()*2//3]
+	first = []
+	full = []
+	for x, y, cols in sizes[1:]+sizes[:1]:
+		start = time.perf_counter()
+		layout = ready_text(text, *page_size(x, y, cols), merge, workers, layout)
+		find_page_with_word(word, layout.index)
+		first.append(time.perf_counter()-start)
+		layout.wait_until_done()
+		full.append(time.perf_counter()-start)
+	report.row('resize to reading position'+suffix, name, 'mean', '%.3fs'%(sum(first)/len(first)), '', '', '')
+	report.row('resize to reading position'+suffix, name, 'worst', '%.3fs'%max(first), '', '', '')
+	report.row('resize, full relayout'+suffix, name, 'mean', '%.3fs'%(sum(full)/len(full)), '', '', '')
+
+def run_startup(report, budget_ms):
+	# Times opening a generated .txt book in a new Python process, compared with starting Python and doing nothing
+	with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False, encoding='utf-8') as f:
+		f.write(make_book(parse_size('1M')))
+		filename = f.name
+	try:
+		width, height = page_size(80, 24, 2)
+		here = path.dirname(path.abspath(__file__))
+		for name, command in (('python startup', [sys.executable, '-c', 'pass']), ('cold start', [sys.executable, '-c', startup_script, str(width), str(height), '--no-cache', '-m', filename])):
+			times = [timed(subprocess.run, command, cwd=here, check=True)[1] for _ in range(startup_runs)]
+			report.result(name, 'wrapped 1.0M .txt' if name == 'cold start' else '', 'fastest', min(times))
+		if min(times)*1000 > budget_ms:
+			report.fail('cold start took %.0fms, over the budget of %dms'%(min(times)*1000, budget_ms))
+	finally:
+		os.remove(filename)
+
+def main():
+	par = ap.ArgumentParser(description = 'Benchmarks for the Book page layout code')
+	par.add_argument('--sizes', default='200k,1M', help = 'Comma-separated sizes of the books to generate, in characters (k and M suffixes allowed)')
+	par.add_argument('--terminals', default='80x24,120x40,200x60', help = 'Comma-separated terminal sizes to lay out for')
+	par.add_argument('--cols', default='1,2,3', help = 'Comma-separated column counts to lay out for')
+	par.add_argument('--no-reference', action = 'store_false', dest = 'reference', help = 'Do not time justify_words() or check the fast engine against it (it is slow on big books)')
+	par.add_argument('--golden', help = 'File of page digests to check against; digests that are missing are added to it')
+	par.add_argument('-j', '--jobs', type=int, default=None, help = 'Number of processes for the parallel layout benchmarks (default: one per CPU); 1 skips them')
+	par.add_argument('--quick', action = 'store_true', help = 'Only the first book variant, for a quick check')
+	par.add_argument('--startup-budget', type=int, default=startup_budget_ms, metavar = 'MS', help = 'Longest that opening a .txt book in a new process may take, in milliseconds (default: %(default)s)')
+	args = par.parse_args()
+
+	sizes = []
+	for term in args.terminals.split(','):
+		x, y = map(int, term.lower().split('x'))
+		for cols in map(int, args.cols.split(',')):
+			if page_size(x, y, cols)[0] >= 6:
+				sizes.append((x, y, cols))
+	golden = None
+	if args.golden:
+		golden = {}
+		if path.exists(args.golden):
+			with open(args.golden) as f:
+				golden = json.load(f)
+	variants = [
+		('wrapped', dict(wrapped=True), True),
+		('wrapped+indent', dict(wrapped=True, indented=True), True),
+		('unwrapped+long', dict(wrapped=False, long_words=True), False),
+		('wrapped, unmerged', dict(wrapped=True, indented=True, long_words=True), False),
+	]
+	if args.quick:
+		variants = variants[:1]
+	report = Report()
+	for size in map(parse_size, args.sizes.split(',')):
+		for name, opts, merge in variants:
+			run_book(report, '%s %s'%(name, fmt_rate(size, 1)), make_book(size, **opts), merge, sizes, args, golden)
+	run_startup(report, args.startup_budget)
+	if golden is not None:
+		with open(args.golden, 'w') as f:
+			json.dump(golden, f, indent=1, sort_keys=True)
+	if report.failures:
+		print('%d check%s failed'%(report.failures, '' if report.failures == 1 else 's'))
+		exit(1)
+
+if __name__ == '__main__':
+	main()
@@ -5,36 +5,25 @@ import argparse as ap
 import re
 import sys
 import os
+import locale
+import codecs
+import errno
+import time
+import shutil
 from os import path
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import islice
 
 from libjust import *
+import libjust
+import bookcache
+import profiling
+import search
+import compressed
+from library import Library, OpenBook, library_files, book_memory
 
-try:
-	import pyperclip
-	paste = True
-except ImportError:
-	paste = False
-
-try:
-	import procname
-	procname.setprocname('book')
-except ImportError:
-	pass
-
-epub = True
-ebl = True
-bs = True
-try:
-	import ebooklib
-	from ebooklib import epub
-except ImportError:
-	epub = False
-	ebl = False
-try:
-	import bs4
-except ImportError:
-	epub = False
-	bs = False
+pyperclip = None	# Imported by import_pyperclip() the first time the clipboard is used, as few books come from it
 
 # Key constants
 uparrows = [curses.KEY_UP, ord('k')]
@@ -50,9 +39,14 @@ esc_char = chr(esc)
 
 min_col_width = 7
 min_height = 6
+resize_settle_ms = 100	# How long the terminal size has to stay the same before the book is laid out again for it
+layout_poll_ms = 50	# How often the interim view shown while waiting for a new layout checks whether it's ready
+load_poll_ms = 250	# How often more of a book that is still being loaded (an epub book, or one coming from standard input) is added to the layout
+read_ahead_spreads = 1	# How many screens of pages either side of the one shown are drawn ahead of time, while waiting for a key, so that turning to them only has to copy them onto the screen
 
 par = ap.ArgumentParser(description = 'Terminal ebook reader')
 par.add_argument('i', nargs='?', help = 'File to read from')
+par.add_argument('more', nargs='*', help = 'More files to read, which opens them all as a library to switch between, as does giving a directory')
 par.add_argument('-e', '--epub', action = 'store_true', help = 'Read the specified file as an epub book', dest = 'e')
 par.add_argument('-m', '--merge-lines', action = 'store_true', help = 'Merge lines separated by only a single newline', dest = 'm')
 par.add_argument('-c', '--cols', type=int, default=2, help = 'Number of columns to display', dest = 'c')
@@ -60,53 +54,159 @@ par.add_argument('-p', '--clipboard', action = 'store_true', help = 'Get input f
 par.add_argument('--no-mouse', action = 'store_false', help = 'Disable mouse support', dest = 'u')
 par.add_argument('-u', '--mouse', action = 'store_true', help = 'Enable mouse support (the default)', dest = 'u')
 par.add_argument('-n', '--no-warn', action = 'store_true', help = 'Do not warn before quitting if the current read position is unsaved', dest = 'n')
+par.add_argument('-j', '--jobs', type=int, default=None, help = 'Number of processes to lay out long books in (default: one per CPU)')
+par.add_argument('--no-cache', action = 'store_false', help = 'Do not load or save page layouts or epub text in the cache directory', dest = 'cache')
+par.add_argument('--profile', metavar = 'FILE', default = os.environ.get(profiling.env_var), help = 'Append timings of loading, layout and drawing to FILE as lines of JSON (also set by $%s)'%profiling.env_var)
+par.add_argument('--render', choices = ('plain', 'ansi'), help = 'Instead of opening the reader, write every screen of the book to standard output as it would be shown, reading the book as it goes. ansi clears the screen before each screen and shows the page numbers in reverse video; plain separates screens with form feeds')
+par.add_argument('--width', type=int, help = 'Terminal width to lay the book out for with --render (default: the width of the terminal)')
+par.add_argument('--height', type=int, help = 'Terminal height to lay the book out for with --render (default: the height of the terminal)')
+par.add_argument('--library-memory', type=int, default=512, metavar = 'MB', help = 'In library mode, how much memory the books that are open but not being read can take up before the least recently read are cut down to what is needed to open them again (default: %(default)s)')
 par.add_argument('-v', '--verbose', action = 'store_true', help = 'Print extra info to the status line', dest = 'v')
 
-args = par.parse_args()
+args = None	# The parsed command line, set by main()
 
 re_linebreak = re.compile('(?<!\n)\n(?!\n)')
 re_word = re.compile('[^ ]+')
 
-global text
-
-if args.p:
-	if not paste:
-		sys.stderr.write('Input from clipboard requires the pyperclip module\n')
-		exit(1)
-	text = pyperclip.paste().lstrip(' \r\n').strip()
-	save = False
-elif args.i is None or args.i == '-':
-	infile = sys.stdin
-	text = infile.read()
-	save = False
-	try:
-		newstdin = open('/dev/tty', 'r')
-		os.dup2(newstdin.fileno(), 0)
-	except IOError as e:
-		stdout.write('Error opening /dev/tty: %s. Reading from standard input may not work on this system.'%e.strerror)
+library = None	# The Library, in library mode
+
+# The book, set by load_book()
+book_name = None	# The file it was read from, if any
+text = None	# A string, or the MappedWords or CompressedWords of a book file (None with --render, which reads <infile> as it goes)
+infile = None
+save = False	# Whether the book is a file, whose read position can be saved in <savename>
+savename = None
+text_hash = None	# Identifies the book in the cache
+loader = None	# The EpubLoader of an epub book, the CompressedLoader of a compressed one opened for the first time, or the StreamLoader of one piped in, while the rest of it is loaded in the background
+load_start = None
+last_split = (None, None)	# The text last split into words by ready_text(), and its words. Nothing changes the words once they have been split, so laying the same text out again at another size reuses them
+
+def import_pyperclip():
+	# Imports pyperclip, which is only needed to read from the clipboard, and returns whether it is installed
+	global pyperclip
+	if pyperclip is None:
+		try:
+			import pyperclip
+		except ImportError:
+			return False
+	return True
+
+def is_epub(filename):
+	return args.e or (library is not None and filename.lower().endswith('.epub'))
+
+def check_epub_modules():
+	# Exits with an error message if the modules needed to read epub books aren't installed
+	import epubtext
+	missing = epubtext.missing_modules()
+	if missing:
+		if 'ebooklib' in missing:
+			sys.stderr.write('Reading epub requires the ebooklib python module (https://pypi.org/project/EbookLib/)\n')
+		if 'bs4' in missing:
+			sys.stderr.write('Reading epub requires the BeautifulSoup4 python module (https://pypi.org/project/beautifulsoup4/)\n')
 		exit(1)
-else:
+
+def sidecar_file(filename, extension):
+	# Returns the name of the hidden file with <extension> that is kept next to the book <filename>
+	infilename = path.abspath(filename)
+	return '%s/.%s.%s'%(path.dirname(infilename),path.basename(infilename),extension)
+
+def bookmark_file(filename):
+	return sidecar_file(filename, 'cbookmark')
+
+def open_book(filename):
+	# Opens the book file <filename> (as an epub book if -e was given, or in library mode if its name ends in .epub). Returns its text, the EpubLoader or CompressedLoader the rest of the book is being loaded by (or None), and its text_hash. Raises IOError if it can't be read, including an epub book that isn't in the cache when the modules to parse it aren't installed
+	if is_epub(filename):
+		import epubtext
+		with profiling.timed('epub', file=filename):
+			try:
+				epub_loader = epubtext.EpubLoader(filename, args.cache)
+			except ImportError:	# Not in the cache, and the modules to parse it with aren't installed
+				missing = epubtext.missing_modules()
+				raise IOError(errno.ENOPKG, 'reading epub requires the %s python module%s'%(' and '.join(missing), 's' if len(missing) > 1 else ''), filename)
+		return epub_loader.text, epub_loader, epub_loader.key.hex()	# Only part of the text might be here yet, but the hash only depends on the file
+	encoding = codecs.lookup(locale.getpreferredencoding(False)).name
+	book_format = compressed.file_format(filename)
+	if book_format is not None:	# Opened from its sidecar index if it has been read before, and otherwise decompressed in the background while the index is built
+		with profiling.timed('tokenize', compressed=book_format) as info:
+			digest = bookcache.file_hash(filename)
+			index_file = sidecar_file(filename, 'cindex')
+			index = compressed.read_index(index_file, book_format, digest, encoding)
+			info['indexed'] = index is not None
+			if index is not None:
+				return compressed.CompressedWords(filename, index, args.m), None, digest
+			compressed_loader = compressed.CompressedLoader(filename, book_format, digest, index_file, encoding)
+			return compressed_loader.text, compressed_loader, digest
+	text = None
+	if encoding == 'utf-8':	# Memory-map the file and split it into words without reading it all in, unless it's empty (which can't be mapped) or not in UTF-8
+		try:
+			with profiling.timed('tokenize', mapped=True) as info:
+				text = MappedWords(filename, args.m)
+				info['words'] = len(text)
+		except ValueError:
+			pass
+	if text is None:
+		with open(filename, 'r') as f:
+			text = f.read()
+	return text, None, bookcache.content_hash(text.data if isinstance(text, MappedWords) else text)
+
+def read_bookmark(savename):
+	# Returns the word number saved in the bookmark file <savename>, or None if there isn't one
 	try:
-		infilename = path.abspath(args.i)
-		savename = '%s/.%s.cbookmark'%(path.dirname(infilename),path.basename(infilename))
-		save = True
-		if args.e:
-			if not epub:
-				if not ebl:
-					sys.stderr.write('Reading epub requires the ebooklib python module (https://pypi.org/project/EbookLib/)\n')
-				if not bs:
-					sys.stderr.write('Reading epub requires the BeautifulSoup4 python module (https://pypi.org/project/beautifulsoup4/)\n')
-				exit(1)
-			infile = epub.read_epub(args.i, options={'ignore_ncx':True})
-			text = ''
-			for item in infile.get_items_of_type(ebooklib.ITEM_DOCUMENT):
-				text += bs4.BeautifulSoup(item.get_body_content(), features='lxml').text.rstrip() + '\n\n'
-		else:
-			infile = open(args.i, 'r')
+		with open(savename, 'r') as f:
+			return int(f.read())
+	except (IOError, ValueError):
+		return None
+
+def write_bookmark(savename, word):
+	# Saves the word number <word> in the bookmark file <savename>. Raises IOError if it can't be written
+	with open(savename, 'w') as f:
+		f.write(str(word))
+
+def load_book():
+	# Reads the book given on the command line, exiting with an error message if it can't be
+	global text, infile, save, savename, text_hash, loader, load_start, book_name
+	load_start = time.perf_counter()
+	if args.p:
+		if not import_pyperclip():
+			sys.stderr.write('Input from clipboard requires the pyperclip module\n')
+			exit(1)
+		text = pyperclip.paste().lstrip(' \r\n').strip()
+		save = False
+	elif args.i is None or args.i == '-':
+		infile = sys.stdin
+		save = False
+		if args.render:	# It is read as it is rendered
+			text = None
+		elif infile.isatty():
 			text = infile.read()
-	except IOError as e:
-		sys.stderr.write('Error: Could not open input file %s: %s\n'%(args.i, e.strerror))
-		exit(1)
+		else:	# Show the book as it arrives, reading it from a copy of the pipe while keys are read from the terminal
+			try:
+				newstdin = open('/dev/tty', 'r')
+				pipe = open(os.dup(0), 'rb', buffering=0)
+				os.dup2(newstdin.fileno(), 0)
+			except IOError as e:
+				sys.stderr.write('Error opening /dev/tty: %s. Reading from standard input may not work on this system.\n'%e.strerror)
+				exit(1)
+			loader = StreamLoader(pipe, infile.encoding, infile.errors, args.m)
+			text = loader.text
+	else:
+		if library is None and is_epub(args.i):	# In library mode, only the epub books that are opened need the modules (see open_book())
+			check_epub_modules()
+		book_name = args.i
+		savename = bookmark_file(args.i)
+		save = True
+		try:
+			if args.render and not is_epub(args.i):	# It is read as it is rendered
+				book_format = compressed.file_format(args.i)
+				infile = open(args.i, 'r') if book_format is None else compressed.open_text(args.i, book_format)
+			else:
+				text, loader, text_hash = open_book(args.i)
+				if args.render:
+					text = loader.wait()
+		except IOError as e:
+			sys.stderr.write('Error: Could not open input file %s: %s\n'%(args.i, e.strerror))
+			exit(1)
+	profiling.record('load', time.perf_counter()-load_start, source='clipboard' if args.p else 'file' if save else 'stdin')
 
 class TooSmallError (ValueError):
 	def __init__(self, cols = None):
@@ -129,72 +229,269 @@ def create_column_layout(screen, cols, margin, top, bottom):
 		page_n_wins[i] = screen.derwin(1, page_n_width, y-2, margin+i*(page_width+margin)+page_n_width)
 	return page_wins, page_n_wins, status_win, page_width-1, page_height-1
 def full_screen_msg(screen, msg):
+	screen.erase()
 	try:
-		screen.refresh()
-		screen.addstr(msg)
+		screen.addstr(0, 0, msg)
 	except curses.error:
 		pass
+	screen.noutrefresh()
 def display_page(win, pages, page):
 	(y, x) = win.getmaxyx()
 
 def status(str, win):
 	(y, x) = win.getmaxyx()
+	win.erase()
 	win.addstr(0,0,str[:x-1])
-	win.refresh()
-
-def get_progress_bar(page, pages, win, cols, as_pct):
+	win.noutrefresh()
+
+class Painter:
+# Keeps track of what each window is showing, so that a frame only redraws the windows whose contents have changed and a frame where nothing has changed sends nothing to the terminal. Windows are only marked for update with noutrefresh(); call curses.doupdate() once the frame is drawn
+# Pages are drawn into off-screen pads, which are kept for the pages shown and the pages around them (see read_ahead()), so that showing a page that has been drawn before only copies its pad into the window
+	def __init__(self, screen):
+		self.screen = screen
+		self.reset()
+
+	def reset(self):
+		# Clears the screen and forgets what was on it; call whenever the windows are recreated
+		self.shown = {}
+		self.pads = OrderedDict()	# Page text -> the pad it is drawn in, the most recently used last
+		self.pad_limit = 0
+		self.ahead = []	# The pages still to be drawn by draw_ahead(), as (pages, page number)
+		self.ahead_size = None
+		self.screen.erase()
+		self.screen.noutrefresh()
+
+	def changed(self, key, content):
+		# Records that <key> is to show <content>, returning whether it wasn't showing it already
+		if self.shown.get(key) == content:
+			return False
+		self.shown[key] = content
+		return True
+
+	def page(self, win, text, hl = None):
+		# Shows the page <text> (None for an empty window) in <win>, with the line and starting column in the tuple <hl> highlighted
+		if not self.changed(win, (text, hl)):
+			return
+		if text is None:
+			win.erase()
+		else:
+			(h, w) = win.getmaxyx()
+			self.pad(text, (h, w)).overwrite(win, 0, 0, 0, 0, h-1, w-1)
+			if hl is not None:
+				highlight_line(*hl, win)
+		win.noutrefresh()
+
+	def pad(self, text, size):
+		# Returns the pad of height and width <size> with the page <text> drawn in it, drawing it if it isn't kept already
+		pad = self.pads.get(text)
+		if pad is not None:
+			self.pads.move_to_end(text)
+			return pad
+		pad = curses.newpad(*size)
+		try:
+			pad.addstr(0,0,text)
+		except curses.error:
+			pass
+		self.pads[text] = pad
+		while len(self.pads) > max(1, self.pad_limit):
+			self.pads.popitem(last=False)
+		return pad
+
+	def read_ahead(self, wins, pages, numbers):
+		# Sets the pages to keep pads for: those about to be shown in <wins> and the pages <numbers> of <pages> (a PageLayout's pages), which are queued for draw_ahead() to draw
+		self.pad_limit = len(wins)+len(numbers)
+		self.ahead = [(pages, n) for n in numbers]
+		self.ahead_size = wins[0].getmaxyx() if wins else None
+
+	def draw_ahead(self):
+		# Draws the next page queued by read_ahead() into its pad, returning False if there were none left
+		if not self.ahead:
+			return False
+		pages, n = self.ahead.pop(0)
+		with profiling.timed('readahead', page=n+1):
+			self.pad(pages[n], self.ahead_size)
+		return True
+
+	def bottom(self, status_win, page_n_wins, status_text, page_ns):
+		# Shows <status_text> on the status line if it's set, otherwise the page number strings <page_ns> in <page_n_wins>, which share the status line
+		if not self.changed('bottom', (status_text, page_ns)):
+			return
+		if status_text:
+			status(status_text, status_win)
+			return
+		status_win.erase()
+		status_win.noutrefresh()
+		for win, page_n_str in zip(page_n_wins, page_ns):
+			try:
+				win.addstr(0,0,page_n_str)
+			except curses.error:
+				pass
+			win.noutrefresh()
+
+	def message(self, msg):
+		# Shows <msg> on an otherwise blank screen
+		if self.changed('message', msg):
+			full_screen_msg(self.screen, msg)
+			self.shown = {'message': msg}
+
+def get_progress_bar(page, pages, win, cols, as_pct, more = False, estimated = False):
+# <more> is whether more of the book is still to come, which is shown with a + after the numbers, and <estimated> whether the numbers are only estimates, which is shown with a ~ before them
 	(y, x) = win.getmaxyx()
 	x -= 1
-	pct = page/(pages-(pages%cols))
-	pct_str = str(round(pct*100,2))+'%' if as_pct else f'{page+1}/{pages}'
+	pct = min(1, page/max(cols, pages-(pages%cols)))
+	pct_str = ('~' if estimated else '') + (str(round(pct*100,2))+'%' if as_pct else f'{page+1}/{pages}') + ('+' if more else '')
 	x_left = x - len(pct_str)
 	done = int(pct*x_left)
 	left = x_left-done
 	return '#'*done+'-'*left+pct_str
 
-def ready_text(text, page_width, page_height):
-	if args.m:
-		text = re_linebreak.sub(' ', text)
-	if text[-1] != '\n': text += '\n'
-	words = split_text_into_words(text)
-	pages, index = split_words_into_pages(words, page_width, page_height, 1)
-	return pages, index
-
-def highlight_word(word, page_text, page_win):
-	lines = page_text.split('\n')
-	word_count = 0
-	word_pos = None
-	word_text = ''
-	for l in range(len(lines)):
-		words = re_word.findall(lines[l])
-		new_word_count = word_count + len(words)+1
-		if(new_word_count > word):
-			word_match = words[word-word_count]
-			word_text = word_match.group(0)
-			word_pos = word_match.start(0)
-			page_win.addstr(l, word_pos, word_text, curses.A_REVERSE)
-			page_win.refresh()
-			return
+def text_words(text):
+# Splits <text> into the words that get laid out, merging lines first if -m was given
+	with profiling.timed('tokenize') as info:
+		if args.m:
+			text = re_linebreak.sub(' ', text)
+		if text[-1] != '\n': text += '\n'
+		words = split_text_into_words(text)
+		info['words'] = len(words)
+	return words
+
+def appended_words(words, old_text, new_text, same_chars):
+# Returns the words of <new_text>, given the <words> of <old_text> and that the two texts are the same for their first <same_chars> characters, along with how many words at the start are unchanged. Only the text from the start of the last line (or paragraph, with -m) that is in both is split up again, since line merging and word splitting there can't be affected by what comes later
+	start = old_text.rfind('\n\n' if args.m else '\n', 0, same_chars)
+	if start < 0:
+		return text_words(new_text), 0
+	start += 2 if args.m else 1
+	n_same = len(words)-len(text_words(old_text[start:]))
+	return words[:n_same] + text_words(new_text[start:]), n_same
+
+def ready_text(text, page_width, page_height, old_layout = None, words = None, same_words = 0, saved = None):
+# Starts laying out <text> (a string, or the MappedWords or CompressedWords of a book file) in the background and returns the PageLayout; its pages and index can be used straight away and only block if they get ahead of the layout. Any previous layout passed in <old_layout> is cancelled first. Books read from a file are looked up in the layout cache first, and saved to it once they have been laid out
+# <words> can be given if <text> has already been split into words, and if <same_words> is nonzero then that many words at the start are the same as <old_layout>'s, so its pages that lie within them are kept rather than laid out again. If <old_layout> is of the same words, their WordMetrics are taken from it rather than worked out again, so that only the line breaking is redone
+# <saved> can be the dump() of an earlier layout of the text at this size, which is used instead of looking in the cache
+	global last_split
+	if old_layout:
+		old_layout.cancel()
+	start = time.perf_counter()
+	if not isinstance(text, str):	# MappedWords or CompressedWords, which are already split into words, and merged if need be
+		words = text
+	elif words is None:
+		words = last_split[1] if last_split[0] is text else text_words(text)
+	last_split = (text, words)
+	metrics = old_layout.metrics if old_layout and old_layout.words is words else None
+	key = None
+	if save and args.cache and not (loader and loader.loading()):
+		key = bookcache.make_key('layout', text_hash, page_width, page_height, args.m, libjust.indent_in, libjust.indent_out, 1)
+		if saved is None:
+			saved = bookcache.load('layout', key)
+	if saved is not None:
+		try:
+			layout = PageLayout(words, page_width, page_height, 1, saved=saved, metrics=metrics)
+			profiling.record('layout', time.perf_counter()-start, pages=layout.laid_out(), width=page_width, height=page_height, cached=True)
+			return layout
+		except ValueError:
+			pass
+	def on_done(layout):
+		profiling.record('layout', time.perf_counter()-start, pages=layout.laid_out(), width=page_width, height=page_height, cached=False)
+		if key is not None:
+			bookcache.store('layout', key, layout.dump())
+	return PageLayout(words, page_width, page_height, 1, on_done=on_done, metrics=metrics, prefix=(old_layout, same_words) if old_layout and same_words else None, workers=args.jobs)
+
+def switch_book(name, layout, word, saved_word, page_width, page_height):
+# Makes the library book <name> the one being read, keeping the current one in the library along with its <layout>, reading position <word> and last saved position <saved_word>. Returns the layout, reading position and last saved position of the new book. Raises IOError, and leaves the current book as it is, if the new one can't be read
+	global text, loader, save, savename, text_hash, book_name
+	book, compact = library.take(name)
+	if book is None:
+		try:
+			if compact is not None and compact.packed is not None:
+				book = OpenBook(name, compact.text(), None, True, bookmark_file(name), compact.text_hash, None, 0, 0)
+			else:
+				new_text, new_loader, new_hash = open_book(name)
+				book = OpenBook(name, new_text, new_loader, True, bookmark_file(name), new_hash, None, 0, 0)
+		except IOError:
+			if compact is not None:
+				library.compact[name] = compact
+			raise
+		if compact is not None:
+			book.word, book.saved_word = compact.word, compact.saved_word
 		else:
-			word_count = new_word_count
+			book.word = book.saved_word = read_bookmark(book.savename) or 0
+	library.put(OpenBook(book_name, text, loader, save, savename, text_hash, layout, word, saved_word))
+	library.reading(name)
+	book_name, text, loader, save, savename, text_hash = book.name, book.text, book.loader, book.save, book.savename, book.text_hash
+	if book.layout is not None and (book.layout.width, book.layout.lines) == (page_width, page_height):
+		layout = book.layout
+	else:
+		saved = compact.layout[2] if compact is not None and compact.layout and compact.layout[:2] == (page_width, page_height) else None
+		layout = ready_text(text, page_width, page_height, book.layout, book.layout.words if book.layout is not None and isinstance(text, str) else None, saved=saved)
+	library.trim(book_memory(text, layout))
+	return layout, book.word, book.saved_word
+
+def read_line(screen, painter, status_win, page_n_wins, prompt):
+# Lets the user type a line of text on the status line after <prompt>. Returns the text, or None if Escape is pressed or the terminal is resized (the resize is left to be read again, so that the caller lays out for the new size)
+	text = ''
+	try:
+		curses.curs_set(True)
+	except curses.error:
+		pass
+	screen.timeout(-1)	# Not whatever read_key() left it at, which is 0 if a key came while it was drawing ahead (read_key() sets it again afterwards)
+	try:
+		while True:
+			painter.bottom(status_win, page_n_wins, prompt+text, None)
+			curses.doupdate()
+			try:
+				k = screen.get_wch()
+			except curses.error:
+				continue
+			if k in ('\n', '\r') or k == curses.KEY_ENTER:
+				return text
+			elif k == esc_char:
+				return None
+			elif k == curses.KEY_RESIZE:
+				curses.ungetch(k)
+				return None
+			elif k in (curses.KEY_BACKSPACE, '\x7f', '\b'):
+				text = text[:-1]
+			elif isinstance(k, str) and k.isprintable():
+				text += k
+	finally:
+		try:
+			curses.curs_set(False)
+		except curses.error:
+			pass
+
+def highlight_word(word, line_starts, page_text, page_win):
+# Highlights word number <word> on a page, given the page's table of line starts (see PageLayout.line_table()). Only the line the word is on is looked at
+	line = bisect_right(line_starts[::3], word)-1
+	if line < 0:
+		return
+	first_word, column = line_starts[3*line], line_starts[3*line+1]
+	line_text = page_text.split('\n', line+1)[line]
+	for n, word_match in enumerate(re_word.finditer(line_text, column)):
+		if n == word-first_word:
+			try:
+				page_win.addstr(line, word_match.start(0), word_match.group(0), curses.A_REVERSE)
+			except curses.error:
+				pass
+			page_win.noutrefresh()
+			return
 
-def highlight_line(line, page_text, page_win):
-	line_text=page_text.split('\n')[line]
-	page_win.addstr(line, 0, line_text, curses.A_REVERSE)
-	page_win.refresh()
+def highlight_line(line, column, page_win):
+# Highlights line <line> of a page from <column>, where its first word starts, to the edge of the window
+	try:
+		page_win.chgat(line, column, -1, curses.A_REVERSE)
+	except curses.error:
+		pass
 
-def first_word_of_line(line, page_text):
-	lines = page_text.split('\n')
-	word = 0
-	for line_n in range(min(line, len(lines))):
-		line_text = lines[line_n]
-		line_text = line_text.rstrip()
-		if not line_text:
-			word += 1
-		else:
-			line_words = re_word.findall(line_text)
-			word += len(line_words)
-	return word
+def read_key(screen, painter, timeout):
+# Returns the next key, or -1 if there is none within <timeout> milliseconds (negative to wait for one). Until one comes, pages queued with the Painter's read_ahead() are drawn, one at a time so that a key pressed meanwhile isn't kept waiting for more than one page
+	screen.timeout(0)
+	k = screen.getch()
+	while k == -1 and painter.draw_ahead():
+		k = screen.getch()
+	if k == -1:
+		screen.timeout(timeout)
+		k = screen.getch()
+	return k
 
 def is_win_wide_enough(y, x, cols, margin, top, bottom):
 	page_width = (x-margin*(cols+1))//cols
@@ -242,7 +539,46 @@ curses_mouse_states = {
 margin = 3
 top = 1
 bottom = 2
-def main(screen):
+def render_book(words, x, y, cols, ansi):
+# Writes each screen of the book with the given <words> to standard output as it would be shown in a terminal <x> characters wide and <y> lines high with <cols> columns, as each one is laid out, so that only one screen of the book is ever held in memory. The screens are separated by form feeds, or with <ansi>, each one starts by clearing the terminal and the page numbers are shown in reverse video
+	page_width = (x-margin*(cols+1))//cols
+	if page_width < min_col_width or y < min_height:
+		sys.stderr.write('Error: %dx%d is too small for %d columns\n'%(x, y, cols))
+		exit(1)
+	page_height = y-top-bottom
+	pages = iter_pages(words, page_width-1, page_height-1, 1)
+	page = 0
+	first = True
+	while True:
+		screen = [text.split('\n') for text, _, _ in islice(pages, cols)]
+		if not screen:
+			break
+		lines = []
+		for row in range(y):
+			line = ''
+			length = 0	# How much of <line> shows, leaving out escape sequences
+			for i, page_lines in enumerate(screen):
+				left = margin+i*(page_width+margin)
+				if top <= row < top+page_height:
+					part = page_lines[row-top] if row-top < len(page_lines) else ''
+				elif row == y-2:	# The page numbers
+					left += page_width//2
+					part = str(page+i+1)
+				else:
+					continue
+				if part:
+					line += ' '*(left-length) + (with_sgr(7, part) if ansi and row == y-2 else part)
+					length = left+len(part)
+			lines.append(line)
+		try:
+			sys.stdout.write((csi+'H'+csi+'2J' if ansi else '' if first else '\f') + '\n'.join(lines) + '\n')
+		except BrokenPipeError:	# The output was closed early, as by head
+			os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+			exit(1)
+		first = False
+		page += len(screen)
+
+def reader(screen):
 	global text
 	curses.use_default_colors()
 	curses.curs_set(False)
@@ -251,67 +587,126 @@ def main(screen):
 	cols = args.c
 	too_small_cols = 0
 	status_win = None
+	layout = None
+	painter = Painter(screen)
 	try:
 		page_wins, page_n_wins, status_win, page_width, page_height = create_column_layout(screen, cols, margin, top, bottom)
-		(pages, index) = ready_text(text, page_width, page_height)
+		layout = ready_text(text, page_width, page_height)
+		(pages, index) = (layout.pages, layout.index)
 		too_small = False
 	except TooSmallError as e:
 		too_small = True
 		too_small_cols = e.cols
 	page = 0
 	status_text = None
+	anchor = None	# After a relayout, the word to find the page of once the new layout has got that far
 	def save_bookmark(word):
-		bkmkfile = open(savename, 'w')
-		bkmkfile.write(str(word))
+		nonlocal saved_word
+		write_bookmark(savename, word)
 		saved_word = word
-		bkmkfile.close()
 
+	word = 0
 	if save:
-		try:
-			bkmkfile = open(savename, 'r')
-			word = int(bkmkfile.read())
-			page = find_page_with_word(word, index)
-			page = (page//cols)*cols
-		except Exception as e:
-			word = index[page-1] if page > 0 else 0
-		saved_word = word
-	else:
-		word = 0
+		anchor = read_bookmark(savename)
+		if anchor is not None:
+			word = anchor
+	saved_word = word
 	if args.u:
 		curses.mousemask(curses.ALL_MOUSE_EVENTS)
 
 	hl_page = None
 	hl_line = None
+	hl_col = 0
+	progress = None	# While the progress bar is shown, whether it gives a percentage rather than page numbers
+	searcher = None
+	query = None
+	match = None
+	key_time = None
+	loading = loader is not None and loader.loading()
+	def not_loaded_yet(word):
+		return loading and word >= len(layout.words)-1
 
 	while True:
-		screen.clear()
+		frame_start = time.perf_counter()
+		if loading:	# Add any more of the book that has been loaded
+			more, finished = loader.poll()
+			if more:
+				if layout is not None:
+					new_text = text + more
+					words, same_words = appended_words(layout.words, text, new_text, len(text.rstrip()))
+					text = new_text
+					layout = ready_text(text, page_width, page_height, layout, words, same_words)
+					(pages, index) = (layout.pages, layout.index)
+				else:
+					text += more
+				if searcher:
+					searcher.cancel()
+					searcher = None
+			if finished:
+				loading = False
+				if args.e:
+					profiling.record('epub', time.perf_counter()-load_start, file=book_name, complete=True)
+				else:
+					profiling.record('load', time.perf_counter()-load_start, source='file' if save else 'stdin', complete=True)
+				if loader.error is not None:
+					status_text = 'Error reading the rest of the book: %s'%loader.error
+		if searcher is None and layout is not None and not loading and not isinstance(layout.words, compressed.CompressedWords):	# Start indexing the book for searches (not for a compressed book until the first search, since that means decompressing all of it)
+			searcher = search.SearchIndex(layout.words)
+		if anchor is not None and not too_small and not not_loaded_yet(anchor):
+			found = layout.find_page(anchor, wait=False)
+			if found is not None:
+				page = (found//cols)*cols
+				anchor = None
+		if progress is not None and not too_small:	# Redrawn every time, so that it keeps up with the layout and with a book that is still loading
+			at = page if anchor is None else (layout.estimate_page(anchor)//cols)*cols
+			status_text = get_progress_bar(at, layout.estimate_pages(), status_win, cols, progress, loading, not layout.done)
+		if not too_small and (anchor is not None or (progress is not None and not layout.done)):
+			timeout = layout_poll_ms
+		else:
+			timeout = load_poll_ms if loading else -1
 		if not too_small:
-			for i in range(cols):
-				if page+i < len(pages):
-						if not curses.is_term_resized(y, x):
-							try:
-								page_wins[i].addstr(0,0,pages[page+i])
-							except curses.error:
-								pass
-							if not status_text:
-								page_n_str = str(page+i+1)
-								try:
-									page_n_wins[i].addstr(0,0,page_n_str)
-								except curses.error:
-									pass
-							page_wins[i].refresh()
-							page_n_wins[i].refresh()
-						#highlight_word(1, pages[page+i], page_wins[i])
+			if anchor is not None:	# Show the pages from the reading position while the layout catches up
+				painter.read_ahead(page_wins, None, ())
+				interim = layout.preview(anchor, cols)
+				for i in range(cols):
+					painter.page(page_wins[i], interim[i] if i < len(interim) else None)
+				first = layout.estimate_page(anchor)
+				painter.bottom(status_win, page_n_wins, status_text or ('Loading...' if not interim else None), tuple('~%d'%(first+i+1) if i < len(interim) else '' for i in range(cols)))
+			elif not curses.is_term_resized(y, x):
+				spread = read_ahead_spreads*cols
+				painter.read_ahead(page_wins, pages, [n for n in list(range(page+cols, page+cols+spread)) + list(range(page-1, page-spread-1, -1)) if 0 <= n < layout.laid_out()])
+				for i in range(cols):
+					painter.page(page_wins[i], pages[page+i] if pages.has(page+i) else None, (hl_line, hl_col) if hl_line is not None and i == hl_page else None)
+					#highlight_word(word, layout.line_starts[page+i], pages[page+i], page_wins[i])
+				painter.bottom(status_win, page_n_wins, status_text, tuple(str(page+i+1) if pages.has(page+i) else '' for i in range(cols)))
 		else:
 			newline = '\n'
-			full_screen_msg(screen, f'Terminal is too small{" for " + str(too_small_cols) + " columns!" + newline + "(- to decrease columns)" if too_small_cols > 1 else "!"}')
-		if status_text and status_win:
-			status(status_text, status_win)
-			status_text = None
-		if hl_line is not None:
-			highlight_line(hl_line, pages[page+hl_page], page_wins[hl_page])
-			hl_line = None
-		k = screen.getch()
+			painter.read_ahead((), None, ())
+			painter.message(f'Terminal is too small{" for " + str(too_small_cols) + " columns!" + newline + "(- to decrease columns)" if too_small_cols > 1 else "!"}')
+			if status_text and status_win:
+				painter.bottom(status_win, page_n_wins, status_text, None)
+		status_text = None
+		hl_line = None
+		curses.doupdate()
+		painted = time.perf_counter()
+		profiling.record('render', painted-frame_start, page=page+1, cols=cols)
+		if key_time is not None:	# Time from reading the last key to having drawn its result
+			profiling.record('key', painted-key_time, key=k)
+		k = read_key(screen, painter, timeout)
+		key_time = time.perf_counter()
+		if k == -1:	# Timed out waiting for the layout
+			key_time = None
+			continue
+		if progress is not None:
+			progress = None
+			if k != curses.KEY_RESIZE:	# Any other key only takes the progress bar away
+				continue
+		if anchor is not None and layout is not None and k not in (curses.KEY_RESIZE, ord('q'), ord('p')) and not (k == ord('n') and not query):	# Any other key but the progress bar acts on the real pages, so wait for the layout to reach them
+			if not_loaded_yet(anchor):
+				status_text = 'Still loading the book'
+				continue
+			page = (find_page_with_word(anchor, index)//cols)*cols
+			anchor = None
 		if k == curses.KEY_MOUSE:
 			try:
 				mouse_id, mouse_x, mouse_y, mouse_z, state = curses.getmouse()
@@ -323,7 +718,7 @@ def main(screen):
 				elif state & curses.BUTTON3_CLICKED:
 					mouse_page_rel, mouse_line = find_clicked_line(mouse_x, mouse_y, top, margin, page_width, len(page_wins), page_wins[0].getmaxyx()[0])
 					mouse_page = page + mouse_page_rel
-					word = (index[mouse_page-1] if mouse_page > 0 else 0) + first_word_of_line(mouse_line, pages[mouse_page])
+					word, hl_col = layout.line_start(mouse_page, mouse_line)
 					hl_line = mouse_line
 					hl_page = mouse_page_rel
 					if args.v:
@@ -338,17 +733,25 @@ def main(screen):
 			except (curses.error, IndexError):
 				continue
 		if k == ord('q'):
-			if (not args.n) and save and (saved_word != word):
-				status_text=('Save new read position before quitting? (Y/N)')
-				status(status_text, status_win)
+			unsaved = [(savename, word)] if save and saved_word != word else []
+			if library is not None:	# The books switched away from keep their places too
+				unsaved += library.unsaved(bookmark_file)
+			if (not args.n) and unsaved:
+				status_text=('Save new read position%s before quitting? (Y/N)'%('s' if len(unsaved) > 1 else ''))
+				painter.bottom(status_win, page_n_wins, status_text, None)
+				curses.doupdate()
+				screen.timeout(-1)	# Wait for the answer, whatever timeout the layout or loading had the main loop polling with (read_key() sets it again afterwards)
 				while True:
 					k = screen.getch()
+					key_time = time.perf_counter()
 					if k == ord('y') or k == ord('Y'):
 						try:
-							save_bookmark(word)
+							for name, at in unsaved:
+								write_bookmark(name, at)
 							exit(0)
 						except IOError as e:
-							status_text = '%s: %s'%(savename, e.strerror)
+							status_text = '%s: %s'%(e.filename, e.strerror)
+							break
 					elif k == ord('n') or k == ord('N'):
 						exit(0)
 					else:
@@ -357,7 +760,7 @@ def main(screen):
 			else:
 				exit(0)
 		elif k in nextpage:
-			if page+cols < len(pages):
+			if pages.has(page+cols):
 				page += cols
 				word = index[page-1] if page > 0 else 0
 		elif k in prevpage:
@@ -369,9 +772,10 @@ def main(screen):
 				if not too_small:
 					cols += 1
 					page_wins, page_n_wins, status_win, page_width, page_height = create_column_layout(screen, cols, margin, top, bottom)
-					(pages, index) = ready_text(text, page_width, page_height)
-					page = find_page_with_word(word, index)
-					page = (page//cols)*cols
+					painter.reset()
+					layout = ready_text(text, page_width, page_height, layout)
+					(pages, index) = (layout.pages, layout.index)
+					anchor = word
 			except TooSmallError as e:
 				cols -= 1
 			status_text = '%s column%s'%(cols,'' if cols == 1 else 's')
@@ -380,9 +784,10 @@ def main(screen):
 				if cols > 1:
 					cols -= 1
 					page_wins, page_n_wins, status_win, page_width, page_height = create_column_layout(screen, cols, margin, top, bottom)
-					(pages, index) = ready_text(text, page_width, page_height)
-					page = find_page_with_word(word, index)
-					page = (page//cols)*cols
+					painter.reset()
+					layout = ready_text(text, page_width, page_height, layout)
+					(pages, index) = (layout.pages, layout.index)
+					anchor = word
 					too_small = False
 			except TooSmallError as e:
 				too_small = True
@@ -399,36 +804,105 @@ def main(screen):
 					status_text = '%s: %s'%(savename, e.strerror)
 			else:
 				status_text = 'Input not from file, save not available'
+		elif k == ord('/') or (k in (ord('n'), ord('N')) and query):
+			if layout is None:
+				continue
+			if searcher is None:	# Still loading; search what there is so far
+				searcher = search.SearchIndex(layout.words)
+			if k == ord('/'):
+				typed = read_line(screen, painter, status_win, page_n_wins, '/')
+				key_time = time.perf_counter()
+				if not typed:
+					continue
+				query = typed
+				start = index[page-1] if page > 0 else 0
+			elif match is None:
+				start = word
+			else:
+				start = match+1 if k == ord('n') else match
+			backward = k == ord('N')
+			with profiling.timed('search', indexed=searcher.indexed):
+				found = searcher.find(layout.words, query, start, backward)
+			if found is None:
+				status_text = 'Not found: %s'%query
+			else:
+				match = word = found
+				match_page = find_page_with_word(found, index)
+				page = (match_page//cols)*cols
+				hl_page = match_page-page
+				hl_line, hl_col = layout.word_line(match_page, found)
+				wrapped = found >= start if backward else found < start
+				status_text = '/%s%s'%(query, ' (search wrapped)' if wrapped else '')
 		elif k == ord('p') or k == ord('n'):
-			status_text = get_progress_bar(page, len(pages), status_win, cols, k == ord('p'))
-			status(status_text, status_win)
-			screen.getch()
-			status_text = None
+			progress = k == ord('p')
+		elif library is not None and k in (ord('['), ord(']'), ord('b')) and not too_small:
+			if k == ord('b'):
+				name = library.last_read()
+			else:
+				name = library.files[(library.files.index(book_name)+(1 if k == ord(']') else -1))%len(library.files)]
+			if name is None or name == book_name:
+				status_text = 'No other book to switch to'
+			else:
+				if searcher:
+					searcher.cancel()
+					searcher = None
+				try:
+					layout, word, saved_word = switch_book(name, layout, word if anchor is None else anchor, saved_word, page_width, page_height)
+				except IOError as e:
+					status_text = 'Could not open %s: %s'%(name, e.strerror)
+				else:
+					(pages, index) = (layout.pages, layout.index)
+					page = 0
+					anchor = word
+					query = match = None
+					loading = loader is not None and loader.loading()
+					status_text = '%s (%d of %d)'%(path.basename(name), library.files.index(name)+1, len(library.files))
 		elif k == ord('P') or k == 0x10:  # 0x10 = Ctrl-p
-			if not paste:
+			if not import_pyperclip():
 				status_text = 'Pasting from clipboard requires the pyperclip module'
 			elif save:
 				status_text = 'Input was from a file, cannot paste'
+			elif loading:
+				status_text = 'Still loading the book'
 			else:
 				pasted = pyperclip.paste().lstrip(' \r\n').rstrip()
 				if not pasted:
 					status_text = 'No text on clipboard'
 				else:
+					words = None
+					same_words = 0
 					if k == 0x10:
 						text = pasted
 						status_text = 'Pasted (replacing)'
 						page = 0
 					else:
-						text = text.lstrip(' \r\n').rstrip() + ('\n\n' if args.m else '\n') + pasted
+						kept = text.lstrip(' \r\n').rstrip()
+						new_text = kept + ('\n\n' if args.m else '\n') + pasted
+						if layout and text[:1] not in ' \r\n':	# Only the end of the text has changed, so only lay out from there
+							words, same_words = appended_words(layout.words, text, new_text, len(kept))
+						text = new_text
 						status_text = 'Pasted (appending)'
-					(pages, index) = ready_text(text, page_width, page_height)
+					layout = ready_text(text, page_width, page_height, layout, words, same_words)
+					if searcher:
+						searcher.cancel()
+						searcher = None
+					match = None
+					(pages, index) = (layout.pages, layout.index)
+		elif k == ord('t'):
+			status_text = profiling.summary() if profiling.enabled() else 'Timing is off; run with --profile FILE to turn it on'
 		elif k == curses.KEY_RESIZE:
-			oldpage = page
+			screen.timeout(resize_settle_ms)	# Wait out the rest of a burst of resizes, so that only the final size gets laid out
+			while k == curses.KEY_RESIZE:
+				k = screen.getch()
+			screen.timeout(-1)
+			if k != -1:
+				curses.ungetch(k)
 			try:
 				page_wins, page_n_wins, status_win, page_width, page_height = create_column_layout(screen, cols, 3, 1, 2)
-				(pages, index) = ready_text(text, page_width, page_height)
-				page = find_page_with_word(word, index)
-				page = (page//cols)*cols
+				painter.reset()
+				layout = ready_text(text, page_width, page_height, layout)
+				(pages, index) = (layout.pages, layout.index)
+				anchor = word
 				too_small = False
 			except TooSmallError as e:
 				too_small = True
@@ -440,5 +914,35 @@ def main(screen):
 		elif args.v:
 			status_text = str(k)
 
-curses.wrapper(main)
-set_mouse_mode(False)
+def main(argv = None):
+	# Runs the reader with the command line arguments <argv> (by default sys.argv[1:])
+	global args, library
+	args = par.parse_args(argv)
+	if args.more or (args.i and path.isdir(args.i)):
+		library = Library(library_files([args.i]+args.more), args.library_memory<<20)
+		if not library.files:
+			sys.stderr.write('Error: No books in %s\n'%args.i)
+			exit(1)
+		args.i = library.files[0]
+		library.reading(args.i)
+	try:
+		import procname
+		procname.setprocname('book')
+	except ImportError:
+		pass
+	if args.profile:
+		try:
+			profiling.start(args.profile)
+		except IOError as e:
+			sys.stderr.write('Error: Could not open profile file %s: %s\n'%(args.profile, e.strerror))
+			exit(1)
+	load_book()
+	if args.render:
+		x, y = shutil.get_terminal_size()
+		render_book(text_words(text) if text is not None else iter_words(infile, args.m), args.width or x, args.height or y, args.c, args.render == 'ansi')
+	else:
+		curses.wrapper(reader)
+		set_mouse_mode(False)
+
+if __name__ == '__main__':
+	main()
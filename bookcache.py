@@ -0,0 +1,101 @@
+import os
+import hashlib
+import struct
+import zlib
+from os import path
+
+# On-disk cache for results that are slow to work out but can be recreated at any time, such as the page layout of a book at a particular size. Entries are kept in $XDG_CACHE_HOME/book (~/.cache/book by default), one file per entry, and the least recently used ones are deleted once the cache grows past max_cache_size bytes.
+# Each file starts with a header holding the full key it was stored under and a checksum of its contents, and anything that doesn't match is treated as a miss (and deleted), so a stale or damaged entry is never used.
+
+cache_dir = path.join(os.environ.get('XDG_CACHE_HOME') or path.expanduser('~/.cache'), 'book')
+max_cache_size = 64*1024*1024
+
+magic = b'BKCACHE1'
+header = struct.Struct('<8s32sIQ')	# Magic, key digest, CRC-32 of the data, length of the data
+
+def content_hash(data):
+	# Returns a hex digest identifying the contents of <data>, which can be a string or bytes
+	if isinstance(data, str):
+		data = data.encode('utf-8', 'surrogatepass')
+	return hashlib.sha256(data).hexdigest()
+
+def file_hash(filename):
+	# Returns the content_hash() of the file <filename> without reading it all into memory at once
+	h = hashlib.sha256()
+	with open(filename, 'rb') as f:
+		for chunk in iter(lambda: f.read(1<<20), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+def make_key(kind, *parts):
+	# Turns a kind of entry (e.g. 'layout') and the values it depends on into the key used to store it
+	return hashlib.sha256(repr((kind,)+parts).encode()).digest()
+
+def entry_path(kind, key):
+	return path.join(cache_dir, '%s-%s'%(kind, key.hex()[:40]))
+
+def load(kind, key):
+	# Returns the data stored under <key>, or None if there is no valid entry for it
+	filename = entry_path(kind, key)
+	try:
+		with open(filename, 'rb') as f:
+			head = f.read(header.size)
+			data = f.read()
+	except OSError:
+		return None
+	try:
+		file_magic, file_key, crc, length = header.unpack(head)
+	except struct.error:
+		file_magic = None
+	if file_magic != magic or file_key != key or length != len(data) or crc != zlib.crc32(data):
+		remove(filename)
+		return None
+	try:
+		os.utime(filename)	# Mark it as recently used
+	except OSError:
+		pass
+	return data
+
+def store(kind, key, data):
+	# Saves <data> (bytes) under <key>, then trims the cache back down to max_cache_size. Failures are ignored, since the cache is only an optimization
+	filename = entry_path(kind, key)
+	tmpname = '%s.%d.tmp'%(filename, os.getpid())
+	try:
+		os.makedirs(cache_dir, exist_ok=True)
+		with open(tmpname, 'wb') as f:
+			f.write(header.pack(magic, key, zlib.crc32(data), len(data)))
+			f.write(data)
+		os.replace(tmpname, filename)
+	except OSError:
+		remove(tmpname)
+		return
+	evict()
+
+def evict(limit = None):
+	# Deletes the least recently used entries until the cache takes up no more than <limit> bytes (max_cache_size by default)
+	if limit is None:
+		limit = max_cache_size
+	entries = []
+	try:
+		with os.scandir(cache_dir) as it:
+			for entry in it:
+				try:
+					st = entry.stat()
+				except OSError:
+					continue
+				entries.append((st.st_mtime, st.st_size, entry.path))
+	except OSError:
+		return
+	total = sum(e[1] for e in entries)
+	entries.sort()
+	for _, size, filename in entries:
+		if total <= limit:
+			break
+		remove(filename)
+		total -= size
+
+def remove(filename):
+	try:
+		os.remove(filename)
+	except OSError:
+		pass
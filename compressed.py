@@ -0,0 +1,497 @@
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+
+from libjust import split_text_into_words, re_single_newline, re_newline, BackgroundLoader
+
+# Reads books compressed with gzip, bzip2 or xz without decompressing them to a file first. The first time a book is opened it is decompressed from start to end by a CompressedLoader, which shows it as it goes (like a book coming from standard input), and on the way notes the points in the file that decompression can start again from, and how many words come before them. These are saved in a small sidecar index next to the book's bookmark, and from then on the book is opened as CompressedWords, which only decompresses the part of the book around a word when that word is asked for: going to a bookmark near the end of a long book doesn't mean decompressing everything before it.
+# Where decompression can start from depends on the format:
+#	gzip: the start of each gzip member, and about every point_spacing bytes of text, the start of a deflate block, along with the 32KB of text before it (which the block can refer back to). Python's zlib doesn't say where blocks start, so this is worked out as the book is decompressed (see scan_gzip())
+#	bzip2: the start of each block, which holds up to 900KB of text and doesn't depend on the others
+#	xz: the start of each block, which are listed in the index at the end of the file. xz only splits its files into blocks when compressing with several threads or with --block-size, so a book compressed in one block has to be decompressed from the start
+
+point_spacing = 1<<20	# Bytes of text between the points a gzip book can be decompressed from
+region_size = 1<<17	# Most bytes of text in each region that CompressedWords decompresses and splits into words at once (if its paragraphs allow)
+piece_size = 1<<16	# Least bytes of text CompressedLoader hands out at once
+read_chunk = 1<<16	# Bytes of a compressed file decompressed at once
+window_size = 1<<15	# How far back a deflate block can refer
+verify_size = 1<<12	# Bytes of text a possible block start in a gzip book has to give the right text for
+quiet_bytes = 8	# Bytes of deflate data that give no text at all that can only be the header of a block, since every other symbol takes up 48 bits at most
+
+gzip_magic = b'\x1f\x8b'
+bzip2_block_magic = 0x314159265359	# The 48 bits each bzip2 block starts with...
+bzip2_end_magic = 0x177245385090	# ...and the end of each bzip2 stream
+xz_magic = b'\xfd7zXZ\x00'
+
+index_magic = b'BKINDEX1'
+index_header = struct.Struct('<8s8s64s32sQQQIII')	# Magic, format, digest of the compressed file, encoding, size of the text, words, words with --merge-lines, number of points, number of regions, CRC-32 of what follows
+index_point = struct.Struct('<QQQI')	# Starting bit, ending bit, text offset, length of the state that follows
+index_region = struct.Struct('<IQQQ')	# Point, text offset, words before it, words before it with --merge-lines
+
+def file_format(filename):
+	# Returns 'gzip', 'bzip2' or 'xz' if the file <filename> is compressed in that format, otherwise None. Raises IOError if it can't be read
+	with open(filename, 'rb') as f:
+		head = f.read(len(xz_magic))
+	if head.startswith(gzip_magic):
+		return 'gzip'
+	if head[:3] == b'BZh' and head[3:4].isdigit():
+		return 'bzip2'
+	if head == xz_magic:
+		return 'xz'
+	return None
+
+def open_text(filename, book_format, encoding = None):
+	# Opens the compressed book <filename> as a text file that decompresses it as it is read
+	if book_format == 'gzip':
+		import gzip
+		return gzip.open(filename, 'rt', encoding=encoding, errors='replace')
+	if book_format == 'bzip2':
+		import bz2
+		return bz2.open(filename, 'rt', encoding=encoding, errors='replace')
+	import lzma
+	return lzma.open(filename, 'rt', encoding=encoding, errors='replace')
+
+def map_file(filename):
+	with open(filename, 'rb') as f:
+		return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def decode(data, encoding):
+	# Returns the bytes <data> of a book as text, with its line breaks turned into \n as they are when a file is read in text mode
+	return re_newline.sub('\n', data.decode(encoding, 'replace'))
+
+re_b_paragraph = re.compile(b'(?:\r\n|\r|\n){2,}(?=[^\r\n])')
+
+def paragraph_start(data):
+	# Returns the offset in <data> of the start of the last paragraph that begins after two or more line breaks, or 0 if there isn't one. A book can be split into words separately on either side of it, with or without --merge-lines
+	look = 1<<12
+	while True:	# Look through the end of it first, as there is usually a paragraph there
+		start = max(0, len(data)-look)
+		end = 0
+		for match in re_b_paragraph.finditer(data, start):
+			end = match.end()
+		if end or not start:
+			return end
+		look *= 4
+
+def region_words(text, merge_lines, last):
+	# Returns the words of the part of a book <text>, which starts at a paragraph_start() and ends at one (or at the end of the book if it is the <last> part), as split_text_into_words() gives them for the whole book
+	if merge_lines:
+		text = re_single_newline.sub(' ', text)
+	if last:
+		if text[-1:] != '\n':
+			text += '\n'
+		return split_text_into_words(text)
+	words = split_text_into_words(text)
+	words.pop()	# The blank word after the last line break, which is really the start of the next part
+	return words
+
+def shifted(data, start, length, shift):
+	# Returns <length> bytes of <data> starting <shift> bits into byte <start>, as deflate reads them (the lowest bit of each byte first)
+	piece = data[start:start+length+1]
+	if shift:
+		piece = (int.from_bytes(piece, 'little') >> shift).to_bytes(len(piece), 'little')
+	return piece[:length]
+
+def find_block_start(data, byte, window, expected):
+	# Returns the bit of the deflate data <data> that a block starts at, given that it starts within 3 bytes of byte <byte> (see scan_gzip()), that the <window> of text comes before it and that it starts with the text <expected>. Returns None if none of the places it could start give that text
+	for bit in range(8*byte, 8*byte+24):
+		d = zlib.decompressobj(-15, zdict=window)
+		try:
+			if d.decompress(shifted(data, bit >> 3, 4*verify_size, bit & 7), len(expected)) == expected:
+				return bit
+		except zlib.error:
+			pass
+	return None
+
+def scan_gzip(data, points):
+	# Yields the text of the gzip file <data>, adding the points it can be decompressed from to <points> as it goes. Each point is a tuple of the bit it starts at, 0, the offset in the text and either None for the start of a gzip member or the text before it compressed with zlib
+	# To find where a deflate block starts, the data is fed in a byte at a time until a few bytes in a row give no text, which only happens in the header of a block (or at the end of the member). The end-of-block code before the header is at most 15 bits long and comes straight after the last byte that gave some text, so the block starts within 3 bytes of it: each place there is tried, and the one that decompresses to the text that comes next is the start of the block
+	pos = 0
+	out = 0
+	recent = bytearray()	# At least the last window_size bytes of text
+	while data[pos:pos+2] == gzip_magic:
+		points.append((8*pos, 0, out, None))
+		d = zlib.decompressobj(31)
+		last_point = out
+		hunting = False	# Whether it is feeding the data in a byte at a time to find the start of a block
+		quiet = 0	# How many bytes have been fed in since the last one that gave some text
+		last_byte = pos
+		found = None	# The byte near where a block seems to start, its offset in the text and the window of text before it...
+		following = bytearray()	# ...and the text after it so far
+		while not d.eof:
+			if pos >= len(data):
+				raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+			piece = data[pos:pos+(1 if hunting else read_chunk)]
+			text = d.decompress(piece)
+			pos += len(piece)
+			if hunting:
+				if text:
+					last_byte = pos-1
+					quiet = 0
+				else:
+					quiet += 1
+					if quiet >= quiet_bytes:
+						found = (last_byte, out, bytes(recent[-window_size:]))
+						following = bytearray()
+						hunting = False
+			elif found is not None:
+				following += text
+				if len(following) >= verify_size:
+					bit = find_block_start(data, found[0], found[2], bytes(following[:verify_size]))
+					if bit is None:	# Not a block header after all (a stored block, say); keep looking
+						hunting = True
+						quiet = 0
+					else:
+						points.append((bit, 0, found[1], zlib.compress(found[2])))
+						last_point = found[1]
+					found = None
+			if text:
+				out += len(text)
+				recent += text
+				if len(recent) > 2*window_size:
+					del recent[:-window_size]
+				yield text
+			if not hunting and found is None and out-last_point >= point_spacing:
+				hunting = True
+				quiet = 0
+		pos -= len(d.unused_data)
+
+def read_gzip(data, points, i):
+	# Yields the text of the gzip file <data> from point <i> on (see scan_gzip())
+	while i < len(points):
+		bit, _, _, state = points[i]
+		pos, shift = bit >> 3, bit & 7
+		d = zlib.decompressobj(31) if state is None else zlib.decompressobj(-15, zdict=zlib.decompress(state))
+		while not d.eof:
+			if pos >= len(data):
+				raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+			yield d.decompress(shifted(data, pos, read_chunk, shift))
+			pos += read_chunk
+		i += 1
+		while i < len(points) and points[i][3] is not None:	# Carry on from the start of the next member
+			i += 1
+
+def bzip2_markers(data):
+	# Returns the bits of the bzip2 file <data> that each block or end-of-stream marker starts at, in order, as tuples of the bit and whether it is the end of a stream
+	found = []
+	for magic in (bzip2_block_magic, bzip2_end_magic):
+		for shift in range(8):
+			pattern = (magic << (16-shift)).to_bytes(8, 'big')	# The marker starting <shift> bits into a byte, which fills bytes 1 to 5 of it (and 0 too if it starts on a byte)
+			skip = 1 if shift else 0
+			for match in re.finditer(re.escape(pattern[skip:6]), data):
+				byte = match.start()-skip
+				if byte >= 0 and (int.from_bytes(data[byte:byte+8].ljust(8, b'\0'), 'big') >> (16-shift)) & ((1 << 48)-1) == magic:
+					found.append((8*byte+shift, magic == bzip2_end_magic))
+	return sorted(found)
+
+def bzip2_block(data, start, end):
+	# Returns a bzip2 stream that holds just the block running from bit <start> to bit <end> of the bzip2 file <data>
+	first = start >> 3
+	piece = data[first:(end+7) >> 3]
+	n_bits = end-start
+	bits = (int.from_bytes(piece, 'big') >> (8*len(piece)-(end-8*first))) & ((1 << n_bits)-1)
+	crc = (bits >> (n_bits-80)) & 0xffffffff	# The block's CRC, which comes after its marker, is also the CRC of a stream with just that block
+	bits = (((bits << 48) | bzip2_end_magic) << 32) | crc
+	n_bits += 80
+	pad = -n_bits % 8
+	return b'BZh9' + (bits << pad).to_bytes((n_bits+pad) >> 3, 'big')
+
+def scan_bzip2(data, points):
+	# Yields the text of the bzip2 file <data>, adding each of its blocks to <points> as a tuple of the bit it starts at, the bit it ends at, its offset in the text and None
+	import bz2
+	markers = bzip2_markers(data)
+	out = 0
+	k = 0
+	while k < len(markers):
+		start, end_of_stream = markers[k]
+		k += 1
+		if end_of_stream:
+			continue
+		while True:	# The block ends at the next marker, unless that was just some data that looked like one
+			if k >= len(markers):
+				raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+			try:
+				text = bz2.decompress(bzip2_block(data, start, markers[k][0]))
+				break
+			except (OSError, ValueError, EOFError):
+				k += 1
+		points.append((start, markers[k][0], out, None))
+		out += len(text)
+		yield text
+
+def read_bzip2(data, points, i):
+	# Yields the text of the bzip2 file <data> from point <i> on (see scan_bzip2())
+	import bz2
+	for start, end, _, _ in points[i:]:
+		yield bz2.decompress(bzip2_block(data, start, end))
+
+def xz_size(data, pos):
+	# Returns the number stored at byte <pos> of <data> in xz's variable-length format, and the byte after it
+	value = shift = 0
+	while True:
+		byte = data[pos]
+		pos += 1
+		value |= (byte & 0x7f) << shift
+		shift += 7
+		if byte < 0x80 or shift > 63:
+			return value, pos
+
+def xz_number(value):
+	out = bytearray()
+	while value >= 0x80:
+		out.append(value & 0x7f | 0x80)
+		value >>= 7
+	out.append(value)
+	return bytes(out)
+
+def xz_blocks(data):
+	# Returns the blocks of the xz file <data>, as listed in the index of each stream in it, as tuples of the byte it starts at, the byte it ends at (after its padding), and a state of the flags of its stream, its unpadded size and its size decompressed. Raises ValueError if they can't be read
+	blocks = []
+	end = len(data)
+	try:
+		while end > 0:
+			while end >= 4 and data[end-4:end] == b'\0\0\0\0':	# Padding between streams
+				end -= 4
+			footer = data[end-12:end]
+			if footer[10:] != b'YZ':
+				raise ValueError('Not an xz file')
+			flags = footer[8:10]
+			index_start = end-12-(struct.unpack('<I', footer[4:8])[0]+1)*4
+			if data[index_start] != 0:
+				raise ValueError('Damaged xz index')
+			n_records, pos = xz_size(data, index_start+1)
+			records = []
+			for _ in range(n_records):
+				unpadded, pos = xz_size(data, pos)
+				size, pos = xz_size(data, pos)
+				records.append((unpadded, size))
+			start = index_start-sum((unpadded+3) & ~3 for unpadded, _ in records)-12
+			if start < 0 or data[start:start+6] != xz_magic:
+				raise ValueError('Damaged xz index')
+			stream = []
+			pos = start+12
+			for unpadded, size in records:
+				stream.append((pos, pos+((unpadded+3) & ~3), flags+struct.pack('<QQ', unpadded, size)))
+				pos = stream[-1][1]
+			blocks[:0] = stream
+			end = start
+	except (IndexError, struct.error) as e:
+		raise ValueError('Damaged xz file') from e
+	return blocks
+
+def xz_block_text(data, start, end, state):
+	# Yields the text of the xz block from byte <start> to byte <end> of <data>, by decompressing a stream with just that block in it
+	import lzma
+	flags = state[:2]
+	unpadded, size = struct.unpack('<QQ', state[2:])
+	index = b'\0' + xz_number(1) + xz_number(unpadded) + xz_number(size)
+	index += b'\0'*(-len(index) % 4)
+	index += struct.pack('<I', zlib.crc32(index))
+	backward = struct.pack('<I', len(index)//4-1) + flags
+	d = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+	yield d.decompress(xz_magic + flags + struct.pack('<I', zlib.crc32(flags)))
+	for pos in range(start, end, read_chunk):
+		yield d.decompress(data[pos:min(end, pos+read_chunk)])
+	yield d.decompress(index + struct.pack('<I', zlib.crc32(backward)) + backward + b'YZ')
+	if not d.eof:
+		raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+def scan_xz(data, points):
+	# Yields the text of the xz file <data>, adding each of its blocks to <points> as a tuple of the bit it starts at, the bit it ends at, its offset in the text and the state xz_block_text() needs
+	out = 0
+	for start, end, state in xz_blocks(data):
+		points.append((8*start, 8*end, out, state))
+		for text in xz_block_text(data, start, end, state):
+			out += len(text)
+			yield text
+
+def read_xz(data, points, i):
+	# Yields the text of the xz file <data> from point <i> on (see scan_xz())
+	for start, end, _, state in points[i:]:
+		yield from xz_block_text(data, start >> 3, end >> 3, state)
+
+scanners = {'gzip': scan_gzip, 'bzip2': scan_bzip2, 'xz': scan_xz}
+readers = {'gzip': read_gzip, 'bzip2': read_bzip2, 'xz': read_xz}
+
+class BookIndex:
+# What is saved in the sidecar index of a compressed book
+# book_format: 'gzip', 'bzip2' or 'xz'
+# digest: the bookcache.file_hash() of the compressed file, which the index is only used with
+# encoding: what the text was decoded with, which where the words break depends on
+# size: the length of the decompressed text in bytes
+# words, merged_words: the number of words in the book, without and with --merge-lines
+# points: the places decompression can start from (see scan_gzip(), scan_bzip2() and scan_xz())
+# regions: the parts CompressedWords splits the book into, as tuples of the last point before the region starts, the offset in the text it starts at (a paragraph_start()), and the number of words before it without and with --merge-lines
+	def __init__(self, book_format, digest, encoding, size = 0, words = 0, merged_words = 0, points = (), regions = ()):
+		self.book_format = book_format
+		self.digest = digest
+		self.encoding = encoding
+		self.size = size
+		self.words = words
+		self.merged_words = merged_words
+		self.points = list(points)
+		self.regions = list(regions)
+
+	def save(self, filename):
+		# Writes the index to the file <filename>. Failures are ignored, as the index can be built again
+		body = b''.join(index_point.pack(bit, end, offset, len(state or b''))+(state or b'') for bit, end, offset, state in self.points)
+		body += b''.join(index_region.pack(*region) for region in self.regions)
+		head = index_header.pack(index_magic, self.book_format.encode(), self.digest.encode(), self.encoding.encode(), self.size, self.words, self.merged_words, len(self.points), len(self.regions), zlib.crc32(body))
+		tmpname = filename+'.tmp'
+		try:
+			with open(tmpname, 'wb') as f:
+				f.write(head+body)
+			os.replace(tmpname, filename)
+		except OSError:
+			try:
+				os.remove(tmpname)
+			except OSError:
+				pass
+
+	def text(self, data, first = 0):
+		# Yields the text of each region of the compressed file <data> from region <first> on, decompressing it in one go from the point before that region
+		point = self.regions[first][0]
+		ends = [region[1] for region in self.regions[first+1:]] + [self.size]
+		pos = self.points[point][2]	# The offset in the text of the start of <pending>
+		skip = self.regions[first][1]-pos
+		pending = bytearray()
+		r = 0
+		for text in readers[self.book_format](data, self.points, point):
+			pending += text
+			if skip:
+				cut = min(skip, len(pending))
+				del pending[:cut]
+				pos += cut
+				skip -= cut
+			while r < len(ends) and pos+len(pending) >= ends[r]:
+				cut = ends[r]-pos
+				yield decode(bytes(pending[:cut]), self.encoding)
+				del pending[:cut]
+				pos += cut
+				r += 1
+			if r == len(ends):
+				return
+		raise EOFError('Compressed book is shorter than its index says')
+
+def read_index(filename, book_format, digest, encoding):
+	# Returns the BookIndex saved in the file <filename>, or None if there isn't one, or it isn't for the book <digest> in <book_format> decoded with <encoding>
+	try:
+		with open(filename, 'rb') as f:
+			saved = f.read()
+		magic, saved_format, saved_digest, saved_encoding, size, words, merged_words, n_points, n_regions, crc = index_header.unpack_from(saved)
+	except (OSError, struct.error):
+		return None
+	body = memoryview(saved)[index_header.size:]
+	if magic != index_magic or saved_format.rstrip(b'\0') != book_format.encode() or saved_digest != digest.encode() or saved_encoding.rstrip(b'\0') != encoding.encode() or crc != zlib.crc32(body):
+		return None
+	points = []
+	pos = 0
+	try:
+		for _ in range(n_points):
+			bit, end, offset, length = index_point.unpack_from(body, pos)
+			pos += index_point.size
+			points.append((bit, end, offset, bytes(body[pos:pos+length]) if length else None))
+			pos += length
+		regions = [index_region.unpack_from(body, pos+n*index_region.size) for n in range(n_regions)]
+	except struct.error:
+		return None
+	if not regions or pos+n_regions*index_region.size != len(body):
+		return None
+	return BookIndex(book_format, digest, encoding, size, words, merged_words, points, regions)
+
+class CompressedLoader(BackgroundLoader):
+# Decompresses the book <filename>, compressed in <book_format>, in a background thread, so that it can be shown while the rest of it is still being decompressed, and builds its BookIndex on the way, which is saved in <index_file> once it is done. See BackgroundLoader for how it is used
+# digest is the bookcache.file_hash() of the file, and the text is decoded with <encoding>. Text is handed out a paragraph_start() at a time, so that the words of what has been handed out don't change when more comes
+	def __init__(self, filename, book_format, digest, index_file, encoding = 'utf-8'):
+		super().__init__()
+		self._start('book-decompress', filename, BookIndex(book_format, digest, encoding), index_file)
+
+	def _run(self, filename, index, index_file):
+		starts = array('Q')	# Where each piece of text handed out starts...
+		words = array('Q')	# ...and the number of words before it, without and with --merge-lines
+		merged_words = array('Q')
+		def hand_out(piece, last = False):
+			text = decode(bytes(piece), index.encoding)
+			starts.append(index.size)
+			words.append(index.words)
+			merged_words.append(index.merged_words)
+			index.size += len(piece)
+			index.words += len(region_words(text, False, last))
+			index.merged_words += len(region_words(text, True, last))
+			self._hand_out(text)
+		data = map_file(filename)
+		pending = bytearray()
+		for text in scanners[index.book_format](data, index.points):
+			pending += text
+			if len(pending) >= piece_size:
+				cut = paragraph_start(pending)
+				if cut:
+					hand_out(pending[:cut])
+					del pending[:cut]
+		hand_out(pending, True)
+		j = 0
+		for start, before, merged_before in zip(starts, words, merged_words):	# Start a region at the first piece after each point, and wherever the last region has grown to region_size
+			new_point = False
+			while j < len(index.points) and index.points[j][2] <= start:
+				j += 1
+				new_point = True
+			if not index.regions or new_point or start-index.regions[-1][1] >= region_size:
+				index.regions.append((j-1, start, before, merged_before))
+		index.save(index_file)
+
+class CompressedWords:
+# A read-only list of the words of the compressed book <filename>, given its BookIndex <index>, which only decompresses the region of the book a word is in when it is asked for, and keeps the words of the <cache_regions> most recently used regions. The words are the same as split_text_into_words() gives for the decompressed text with a newline added at the end if it doesn't already end with one, and with single line breaks turned into spaces first if <merge_lines> is True, as with book.py's --merge-lines option
+	def __init__(self, filename, index, merge_lines = False, cache_regions = 8):
+		self.data = map_file(filename)
+		self.index = index
+		self.merge_lines = merge_lines
+		self.cache_regions = cache_regions
+		self.starts = array('Q', (region[3 if merge_lines else 2] for region in index.regions))	# The first word of each region
+		self.n_words = index.merged_words if merge_lines else index.words
+		self._regions = OrderedDict()
+		self._lock = threading.Lock()	# The layout, the search index and the reader all get words from different threads
+
+	def __len__(self):
+		return self.n_words
+
+	def __getitem__(self, n):
+		if isinstance(n, slice):
+			return [self[i] for i in range(*n.indices(len(self)))]
+		if n < 0:
+			n += len(self)
+		if not 0 <= n < len(self):
+			raise IndexError('word index out of range')
+		r = bisect_right(self.starts, n)-1
+		return self._region(r)[n-self.starts[r]]
+
+	def __iter__(self):	# Decompresses the book from the start in one go, rather than a region at a time
+		last = len(self.index.regions)-1
+		for r, text in enumerate(self.index.text(self.data)):
+			yield from region_words(text, self.merge_lines, r == last)
+
+	def _region(self, r):
+		# Returns the words of region <r>
+		with self._lock:
+			words = self._regions.get(r)
+			if words is not None:
+				self._regions.move_to_end(r)
+				return words
+		for text in self.index.text(self.data, r):
+			words = region_words(text, self.merge_lines, r == len(self.index.regions)-1)
+			break
+		with self._lock:
+			self._regions[r] = words
+			if len(self._regions) > self.cache_regions:
+				self._regions.popitem(last=False)
+		return words
+
+	def cached(self):
+		# Returns the words of the regions that are being kept
+		with self._lock:
+			return list(self._regions.values())
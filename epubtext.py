@@ -0,0 +1,94 @@
+import os
+import zlib
+import importlib.util
+
+import bookcache
+from libjust import BackgroundLoader, pool_map
+
+ebooklib = None	# Imported by import_modules(), since they are slow to import (bs4 pulls in lxml) and books in the cache don't need them
+epub = None
+bs4 = None
+
+# Gets the plain text out of an epub book. The chapter documents are parsed in parallel in a pool of processes, since BeautifulSoup is slow on big books, and the resulting text is saved in the cache (see bookcache) so that opening the same book again doesn't need to parse anything.
+# EpubLoader only parses the first few documents before returning, and the rest in the background, so that the start of a long book can be shown straight away.
+
+extract_version = 1	# Change this whenever the text that gets extracted changes, so that old cache entries aren't used
+min_pool_documents = 8	# Books with fewer documents than this are parsed in this process, as starting the pool would take longer
+pool_chunk = 16	# Most documents handed to a worker process at once, so that parsed documents come back steadily
+first_documents = 2	# EpubLoader parses at least this many documents before the book is shown...
+first_chars = 20000	# ...and keeps going until it has at least this much text
+
+def missing_modules():
+	# Returns the names of the modules needed to parse epub books that aren't installed, without importing them
+	return [name for name in ('ebooklib', 'bs4') if importlib.util.find_spec(name) is None]
+
+def import_modules():
+	global ebooklib, epub, bs4
+	import ebooklib
+	from ebooklib import epub
+	import bs4
+
+def document_text(content):
+	# Returns the text of one epub document, given its body content. Run in the worker processes
+	if bs4 is None:
+		import_modules()
+	return bs4.BeautifulSoup(content, features='lxml').text.rstrip() + '\n\n'
+
+def book_documents(book):
+	# Returns the documents of an ebooklib book in reading (spine) order, followed by any documents that aren't in the spine
+	documents = list(book.get_items_of_type(ebooklib.ITEM_DOCUMENT))
+	by_id = {item.get_id(): item for item in documents}
+	ordered = []
+	for entry in book.spine:
+		item = by_id.pop(entry[0] if isinstance(entry, tuple) else entry, None)
+		if item is not None:
+			ordered.append(item)
+	return ordered + [item for item in documents if item.get_id() in by_id]
+
+def iter_documents(contents, workers = None):
+	# Yields the text of each document in <contents>, in the same order, as they are parsed
+	if len(contents) < min_pool_documents:
+		workers = 1
+	n_workers = workers or os.cpu_count() or 1
+	yield from pool_map(document_text, contents, workers=workers, chunksize=max(1, min(pool_chunk, len(contents)//(4*n_workers))))
+
+def parse_documents(contents, workers = None):
+	# Returns a list of the text of each document in <contents>, in the same order
+	return list(iter_documents(contents, workers))
+
+class EpubLoader(BackgroundLoader):
+# Reads the plain text of the epub book <filename>, with two newlines after each document. The first documents, enough for a few screens, are parsed before this returns and are in <text>; the rest are parsed in the background, in reading order, and handed out by poll(). Since the documents are put together the same way either way, word numbers (and so bookmarks) don't depend on how much had been loaded when they were worked out
+# Once the whole book has been parsed its text is saved in the cache, and if it is already there then <text> is the whole book and there is nothing to load
+	def __init__(self, filename, use_cache = True, workers = None):
+		super().__init__()
+		self.key = bookcache.make_key('epub-text', bookcache.file_hash(filename), extract_version)
+		if use_cache:
+			saved = bookcache.load('epub-text', self.key)
+			if saved is not None:
+				try:
+					self.text = zlib.decompress(saved).decode('utf-8')
+					self.done = True
+					return
+				except (zlib.error, UnicodeDecodeError):
+					pass
+		import_modules()
+		book = epub.read_epub(filename, options={'ignore_ncx':True})
+		contents = [item.get_body_content() for item in book_documents(book)]
+		parts = []
+		length = 0
+		while len(parts) < len(contents) and (len(parts) < first_documents or length < first_chars):
+			parts.append(document_text(contents[len(parts)]))
+			length += len(parts[-1])
+		self.text = ''.join(parts)
+		self._start('book-epub', contents[len(parts):], parts, use_cache, workers, wait_for_text=False)
+
+	def _run(self, contents, parts, use_cache, workers):
+		for text in iter_documents(contents, workers):
+			parts.append(text)
+			self._hand_out(text)
+		if use_cache:
+			bookcache.store('epub-text', self.key, zlib.compress(''.join(parts).encode('utf-8')))
+
+def read_epub_text(filename, use_cache = True, workers = None):
+	# Returns the plain text of the epub book <filename>, with two newlines after each document
+	return EpubLoader(filename, use_cache, workers).wait()
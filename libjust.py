@@ -1,4 +1,15 @@
 import re
+import os
+import codecs
+import sys
+import mmap
+import struct
+import threading
+from array import array
+from itertools import accumulate, chain, compress, count, islice, repeat
+from operator import add
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 from sys import stderr
 from math import ceil
 
@@ -20,39 +31,410 @@ def justify_line(words, words_width, line_width):
 		return ''
 	if words[-1] and words[-1][-1] == '\n': # This is the last line of the paragraph, don't justify
 		return ' '.join(words)
-	s = ''
 	spaces = line_width - words_width	# The total n of spaces we need to add
 	word_breaks = len(words)-1	# Number of word breaks in the line
-	if(word_breaks > 0):
-		base_spaces = spaces // word_breaks	# Number of spaces for each word break
-		leftover_spaces = spaces % word_breaks	# Extra spaces left over when n of word breaks doesn't evenly divide number of spaces; we'll add an extra space to only the first however many word breaks
-		for i in range(word_breaks):
-			s += words[i]
-			s += ' '*base_spaces
-			if(i < leftover_spaces): s += ' '
-	s += words[-1]
-	s += '\n'
-	return s
+	if word_breaks == 0:
+		return words[0] + '\n'
+	base_spaces = spaces // word_breaks	# Number of spaces for each word break
+	leftover_spaces = spaces % word_breaks	# Extra spaces left over when n of word breaks doesn't evenly divide number of spaces; we'll add an extra space to only the first however many word breaks
+	gap = ' '*base_spaces
+	if leftover_spaces:
+		wide_gap = gap+' '
+		return wide_gap.join(words[:leftover_spaces]) + wide_gap + gap.join(words[leftover_spaces:]) + '\n'
+	return gap.join(words) + '\n'
 
 def find_page_with_word(word_n, index):
-	for i in range(len(index)):
-		if index[i] > word_n:
-			return i
-	return index[-1]
+# Returns the number of the page containing word <word_n>, given the index of page-end word numbers returned by split_words_into_pages() or PageLayout
+	if isinstance(index, LayoutList):
+		return index.layout.find_page(word_n)
+	return min(bisect_right(index, word_n), len(index)-1)
 
-def split_words_into_pages(words, width, lines, min_width):
-#;This function takes an array of words, as is returned from split_text_into_words(), and splits them into pages of the specified width and height. The min_width argument is used in hyphenating words; if moving the next word to the next line would make the current line shorter than min_width, then that word will instead be broken up with a hyphen and split between the lines.
+def split_words_into_pages(words, width, lines, min_width, fast = False, line_tables = False, workers = 1):
+#;This function takes an array of words, as is returned from split_text_into_words(), and splits them into pages of the specified width and height. The min_width argument is used in hyphenating words; if moving the next word to the next line would make the current line shorter than min_width, then that word will instead be broken up with a hyphen and split between the lines. If <fast> is True, the pages are made by justify_words_fast() rather than justify_words(). The pages are identical, but justify_words_fast() is only quicker at finding where pages end, not at building their text, so it is off by default.
+# If <line_tables> is True, a third list is returned with an array for each page of the first word, starting column and whether it starts part way through that word, for each of its lines (see justify_words()'s line_starts)
+# If <workers> is anything other than 1, the pages are found by parallel_page_ends() and then rendered in a pool of that many processes (or one per CPU if it is None), which gives the same result
+	if workers != 1 and lines:
+		return split_words_in_parallel(words, width, lines, min_width, line_tables, workers)
 	word_n = 0
 	pages = []
 	word_index = []
+	tables = []
+	table = None
 	indent = 0
+	skip = 0
+	metrics = WordMetrics(words) if fast else None
 	while word_n < len(words):
-		page, _, word_n, indent = justify_words(words, width, word_n, min_width, lines, indent)
+		if line_tables:
+			table = array('I')
+			tables.append(table)
+		if fast:
+			page, _, word_n, indent, skip = justify_words_fast(metrics, width, word_n, min_width, lines, indent, skip, line_starts=table)
+		else:
+			page, _, word_n, indent, skip = justify_words(words, width, word_n, min_width, lines, indent, skip, line_starts=table)
 		pages.append(page)
 		word_index.append(word_n)
+	if line_tables:
+		return (pages, word_index, tables)
 	return (pages, word_index)
 
-	
+def iter_pages(words, width, lines, min_width = 1):
+# Yields a tuple of the text, first word number and end word number (as in split_words_into_pages()'s index) of each page of <words>, as each page is laid out, for the same pages as split_words_into_pages(). <words> can be any iterable of words, such as iter_words(), and only the words of the page being laid out (and a few more) are kept, so a book of any length can be gone through in constant memory
+	it = iter(words)
+	buffer = []	# The words that have been read, from word number <base> on
+	base = 0
+	read_ahead = max(64, width*lines//4)	# Words to have read beyond the start of the page before laying it out
+	finished = False
+	word_n = indent = skip = 0
+	while True:
+		start = word_n-base
+		if not finished and len(buffer)-start < read_ahead:
+			new = list(islice(it, read_ahead))
+			buffer += new
+			finished = len(new) < read_ahead
+		if start >= len(buffer):
+			return
+		page, _, end, next_indent, next_skip = justify_words(buffer, width, start, min_width, lines, indent, skip)
+		if end >= len(buffer) and not finished:	# The page ran into the end of the words read so far, so it might carry on past them
+			read_ahead *= 2
+			continue
+		yield page, word_n, base+end
+		word_n, indent, skip = base+end, next_indent, next_skip
+		del buffer[:end]
+		base = word_n
+
+def split_words_in_parallel(words, width, lines, min_width, line_tables, workers):
+# split_words_into_pages() with <workers>
+	ends = list(parallel_page_ends(words, width, lines, min_width, workers))
+	starts = [(0, 0, 0)] + ends[:-1]
+	step = max(1, len(ends)//((workers or os.cpu_count() or 1)*chunks_per_worker))	# Pages rendered by each call of render_pages()
+	groups = range(0, len(ends), step)
+	pages = []
+	tables = []
+	for group_pages, group_tables in pool_map(render_pages, [words[starts[n][0]:ends[min(n+step, len(ends))-1][0]+1] for n in groups], [starts[n][0] for n in groups], [starts[n:n+step] for n in groups], repeat(width), repeat(lines), repeat(min_width), repeat(line_tables), workers=workers):
+		pages += group_pages
+		tables += group_tables
+	index = [word_n for word_n, _, _ in ends]
+	if line_tables:
+		return (pages, index, tables)
+	return (pages, index)
+
+class LayoutCancelled(Exception):
+	pass
+
+class PageLayout:
+# Lays out a list of words into pages in a background thread, so that the first pages can be shown while the rest of the book is still being split up. The pages and index attributes behave like the two lists returned by split_words_into_pages(), except that asking for a page (or index entry) that hasn't been laid out yet blocks until the worker has got that far.
+# Only the position where each page ends is kept, in compact arrays: the word number (the same as split_words_into_pages()'s index), how much of that word the page used up, and the indent carried over to the next page. The text of a page is justified again from that position when it is asked for, and the most recently used pages are kept in an LRU cache, along with the table of where each of their lines starts (see justify_words()'s line_starts), which the line_starts attribute gives.
+# words, width, lines, min_width: as for split_words_into_pages()
+# cache_size: the number of rendered pages to keep
+# saved: bytes from an earlier dump() of a layout of the same words at the same size. The layout is loaded from this instead of being worked out again; ValueError is raised if it isn't a valid layout for these words
+# on_done: function to call (from the worker thread) with the layout once every page has been laid out
+# metrics: the WordMetrics of <words>, if they have already been worked out. Otherwise the worker lays out the first few pages word by word with justify_words(), so they can be shown straight away, then works out the metrics and finds where the rest of the pages end with justify_words_fast(). Pages are always rendered with justify_words()
+# prefix: a tuple of an earlier PageLayout at the same size and a number of words at the start of <words> that are the same as in the earlier layout's words, for when text has been added to the end. The pages that lie within those words are taken from the earlier layout and only the rest are laid out
+# workers: the number of processes to lay out books of at least parallel_min_words words in (see parallel_page_ends()), or None for one per CPU. If it is 1 (or <prefix> is given), everything is done in the worker thread
+	def __init__(self, words, width, lines, min_width = 1, cache_size = 32, saved = None, on_done = None, metrics = None, prefix = None, workers = 1):
+		self.words = words
+		self.workers = workers
+		self.metrics = metrics
+		self.width = width
+		self.lines = lines
+		self.min_width = min_width
+		self.cache_size = cache_size
+		self.done = False
+		self._index = array('I')
+		self._skips = array('I')
+		self._indents = array('I')
+		self._heads = {}	# The leftover text for the rare pages whose start can't be given as a number of characters to skip
+		self._rendered = OrderedDict()
+		self._error = None
+		self._cancelled = False
+		self._cond = threading.Condition()
+		self.on_done = on_done
+		self._base_metrics = None
+		self._sampled_rate = None	# Words per page, from sample_rate()
+		self.pages = LayoutList(self, self.render)
+		self.line_starts = LayoutList(self, self.line_table)
+		self.index = LayoutList(self, self._index.__getitem__)
+		if saved is not None:
+			self._load(saved)
+			self.done = True
+		else:
+			if prefix is not None:
+				self._resume(*prefix)
+			self._thread = threading.Thread(target=self._run, name='book-layout', daemon=True)
+			self._thread.start()
+
+	def _resume(self, old, n_same):
+	# Takes the pages of the PageLayout <old> that only depend on its first <n_same> words
+		if (old.width, old.lines, old.min_width) != (self.width, self.lines, self.min_width):
+			return
+		with old._cond:
+			n_pages = bisect_left(old._index, n_same-1)	# Finding where a page ends can involve looking at the word after it
+			self._index.extend(old._index[:n_pages])
+			self._skips.extend(old._skips[:n_pages])
+			self._indents.extend(old._indents[:n_pages])
+			self._heads.update((page, head) for page, head in old._heads.items() if page < n_pages)
+		self._rendered.update((page, text) for page, text in old._rendered.items() if page < n_pages)
+		if old.metrics is not None and isinstance(self.words, list):
+			self._base_metrics = (old.metrics, n_same)
+
+	def _run(self):
+		word_n, skip, indent = self.page_start(len(self._index))
+		parallel = self.workers != 1 and (self.workers or os.cpu_count() or 1) > 1 and not self._index and self._base_metrics is None and len(self.words) >= parallel_min_words
+		try:
+			while word_n < len(self.words):
+				if self._cancelled:
+					break
+				if parallel and len(self._index) >= quick_pages:
+					self._lay_out_in_parallel()
+					break
+				if self.metrics is None and (len(self._index) >= quick_pages or self._base_metrics):
+					self.metrics = WordMetrics(self.words, *(self._base_metrics or ()))
+					self._base_metrics = None
+				if self.metrics is None:
+					_, _, word_n, indent, skip = justify_words(self.words, self.width, word_n, self.min_width, self.lines, indent, skip)
+				else:
+					_, _, word_n, indent, skip = justify_words_fast(self.metrics, self.width, word_n, self.min_width, self.lines, indent, skip, render=False)
+				self._add_page(word_n, skip, indent)
+		except Exception as e:
+			self._error = e
+		with self._cond:
+			self.done = True
+			self._cond.notify_all()
+		if self.on_done and not self._cancelled and self._error is None:
+			self.on_done(self)
+
+	def _lay_out_in_parallel(self):
+	# Lays out the pages after the first few in a pool of processes, with parallel_page_ends()
+		ends = parallel_page_ends(self.words, self.width, self.lines, self.min_width, self.workers)
+		try:
+			for word_n, skip, indent in islice(ends, len(self._index), None):
+				if self._cancelled:
+					break
+				self._add_page(word_n, skip, indent)
+		finally:
+			ends.close()
+
+	def _add_page(self, word_n, skip, indent):
+		with self._cond:
+			if isinstance(skip, str):
+				self._heads[len(self._index)] = skip
+				self._skips.append(0)
+			else:
+				self._skips.append(skip)
+			self._index.append(word_n)
+			self._indents.append(indent)
+			self._cond.notify_all()
+
+	def dump(self):
+	# Returns the finished layout as bytes that can be passed back in as <saved> to lay the same words out again instantly
+		self.wait_until_done()
+		arrays = [self._index, self._skips, self._indents]
+		if sys.byteorder == 'big':
+			arrays = [array('I', a) for a in arrays]
+			for a in arrays:
+				a.byteswap()
+		heads = b''.join(layout_head.pack(page, len(head.encode()))+head.encode() for page, head in self._heads.items())
+		return layout_header.pack(len(self._index), len(self._heads)) + b''.join(a.tobytes() for a in arrays) + heads
+
+	def _load(self, saved):
+		try:
+			n_pages, n_heads = layout_header.unpack_from(saved)
+			pos = layout_header.size
+			for a in (self._index, self._skips, self._indents):
+				a.frombytes(saved[pos:pos+4*n_pages])
+				pos += 4*n_pages
+				if sys.byteorder == 'big':
+					a.byteswap()
+			for _ in range(n_heads):
+				page, length = layout_head.unpack_from(saved, pos)
+				pos += layout_head.size
+				self._heads[page] = saved[pos:pos+length].decode()
+				pos += length
+		except (struct.error, ValueError, UnicodeDecodeError):
+			raise ValueError('Damaged layout')
+		n_words = len(self.words)
+		if pos != len(saved) or len(self._index) != n_pages or len(self._indents) != n_pages or not n_pages or self._index[-1] != n_words:
+			raise ValueError('Layout does not match the text')
+		check_skips = isinstance(self.words, (list, MappedWords))	# Not for words that would have to be decompressed to be looked at
+		last = 0
+		for page in range(n_pages):
+			word_n = self._index[page]
+			if word_n < last or (check_skips and word_n < n_words and self._skips[page] > len(self.words[word_n])):
+				raise ValueError('Layout does not match the text')
+			last = word_n
+
+	def page_start(self, page):
+	# Returns the word number, characters already used of that word, and carried-over indent that page number <page> starts with
+		if page == 0:
+			return 0, 0, 0
+		return self._index[page-1], self._heads.get(page-1, self._skips[page-1]), self._indents[page-1]
+
+	def render(self, page):
+	# Returns the justified text of page number <page>, which must already have been laid out
+		return self._render(page)[0]
+
+	def line_table(self, page):
+	# Returns an array of the first word, starting column and whether it starts with the rest of a hyphenated word, for each line of page number <page>: three numbers per line (see justify_words()'s line_starts)
+		return self._render(page)[1]
+
+	def line_start(self, page, line):
+	# Returns the word number and column of the first word on line <line> of page <page>, or the first word of the next page and column 0 if the page doesn't have that many lines
+		table = self.line_starts[page]
+		if 3*line >= len(table):
+			return self._index[page], 0
+		return table[3*line], table[3*line+1]
+
+	def word_line(self, page, word_n):
+	# Returns the line of page <page> that word <word_n> is on (or starts on, if it is hyphenated), and the column that line starts at
+		table = self.line_starts[page]
+		if not table:
+			return 0, 0
+		starts = table[::3]
+		line = bisect_left(starts, word_n)
+		if line == len(starts) or starts[line] > word_n:	# The word is part way along the line before
+			line -= 1
+		elif line > 0 and table[3*line+2]:	# The line starts with the rest of the word, which is hyphenated at the end of the line before
+			line -= 1
+		line = max(0, line)
+		return line, table[3*line+1]
+
+	def _render(self, page):
+		rendered = self._rendered.get(page)
+		if rendered is None:
+			word_n, skip, indent = self.page_start(page)
+			table = array('I')
+			text = justify_words(self.words, self.width, word_n, self.min_width, self.lines, indent, skip, table)[0]	# justify_words_fast() only pays for itself when finding breaks, not when building the text
+			rendered = self._rendered[page] = (text, table)
+			if len(self._rendered) > self.cache_size:
+				self._rendered.popitem(last=False)
+		else:
+			self._rendered.move_to_end(page)
+		return rendered
+
+	def find_page(self, word_n, wait = True):
+	# Returns the number of the page containing word <word_n>, waiting only until that page has been laid out. If <wait> is False, returns None instead of waiting
+		with self._cond:
+			while not self.done and (not self._index or self._index[-1] <= word_n):
+				if not wait:
+					return None
+				self._cond.wait()
+			self._check()
+			return min(bisect_right(self._index, word_n), len(self._index)-1)
+
+	def estimate_pages(self):
+	# Returns the number of pages without waiting: exactly if the layout is done, otherwise the pages laid out so far plus an estimate of how many the rest of the words will take (see sample_rate())
+		with self._cond:
+			if self.done:
+				return len(self._index)
+			n_pages = len(self._index)
+			laid_words = self._index[-1] if n_pages else 0
+		return n_pages + ceil((len(self.words)-laid_words)/self.sample_rate(laid_words))
+
+	def estimate_page(self, word_n):
+	# Returns the number of the page containing word <word_n> without waiting: exactly if that page has been laid out, otherwise estimated in the same way as estimate_pages(), which it is always less than
+		with self._cond:
+			n_pages = len(self._index)
+			if self.done or (n_pages and self._index[-1] > word_n):
+				return min(bisect_right(self._index, word_n), n_pages-1)
+			laid_words = self._index[-1] if n_pages else 0
+		return n_pages + int((word_n-laid_words)/self.sample_rate(laid_words))
+
+	def sample_rate(self, start = 0):
+	# Returns the average number of words per page, found the first time it is asked for by laying out sample_pages pages at each of sample_places places spread evenly through the words from word <start> on
+		if self._sampled_rate is None:
+			n_words = len(self.words)
+			n_sampled = n_pages = 0
+			for place in range(sample_places):
+				word_n = start + (n_words-start)*place//sample_places
+				first = word_n
+				indent = skip = 0
+				for _ in range(sample_pages):
+					if word_n >= n_words:
+						break
+					if self.metrics is None:
+						_, _, word_n, indent, skip = justify_words(self.words, self.width, word_n, self.min_width, self.lines, indent, skip)
+					else:
+						_, _, word_n, indent, skip = justify_words_fast(self.metrics, self.width, word_n, self.min_width, self.lines, indent, skip, render=False)
+					n_pages += 1
+				n_sampled += word_n-first
+			self._sampled_rate = max(1, n_sampled/n_pages) if n_pages else 1
+		return self._sampled_rate
+
+	def preview(self, word_n, n_pages):
+	# Returns the text of up to <n_pages> pages laid out from word <word_n> as if it started a line, without waiting for the worker. These won't generally line up with the real pages, but can be shown in the meantime
+		pages = []
+		indent = skip = 0
+		while len(pages) < n_pages and word_n < len(self.words):
+			page, _, word_n, indent, skip = justify_words(self.words, self.width, word_n, self.min_width, self.lines, indent, skip)
+			pages.append(page)
+		return pages
+
+	def wait_for_page(self, page):
+	# Blocks until page number <page> has been laid out or the layout has finished. Returns True if the page exists
+		with self._cond:
+			while len(self._index) <= page and not self.done:
+				self._cond.wait()
+			self._check()
+			return page < len(self._index)
+
+	def wait_until_done(self):
+		with self._cond:
+			while not self.done:
+				self._cond.wait()
+			self._check()
+
+	def _check(self):
+		if self._error is not None:
+			raise self._error
+		if self._cancelled:
+			raise LayoutCancelled()
+
+	def cancel(self):
+	# Tells the worker to stop after the page it is working on. Anything still waiting on this layout gets a LayoutCancelled exception
+		with self._cond:
+			self._cancelled = True
+			self._cond.notify_all()
+
+	def laid_out(self):
+	# Number of pages that have been laid out so far, without waiting
+		return len(self._index)
+
+quick_pages = 4	# Number of pages PageLayout lays out before it stops to work out the WordMetrics
+sample_places = 8	# Places in the book that PageLayout.sample_rate() lays out pages at to estimate the number of pages...
+sample_pages = 2	# ...and the number of pages laid out at each
+
+layout_header = struct.Struct('<II')	# Number of pages, number of entries in PageLayout._heads
+layout_head = struct.Struct('<II')	# Page number and length of an entry in PageLayout._heads
+
+class LayoutList:
+# A read-only view of the pages or index of a PageLayout that waits for the layout worker whenever it is asked for an entry that isn't there yet. <get> is called with the number of a page that has been laid out and returns the entry for it
+	def __init__(self, layout, get):
+		self.layout = layout
+		self.get = get
+
+	def has(self, n):
+	# Returns True if entry <n> exists, waiting only as long as it takes to lay out that many pages
+		return n >= 0 and self.layout.wait_for_page(n)
+
+	def __getitem__(self, n):
+		if isinstance(n, slice):
+			return [self[i] for i in range(*n.indices(len(self)))]
+		if n < 0:
+			n += len(self)
+		if n < 0 or not self.layout.wait_for_page(n):
+			raise IndexError('page out of range')
+		return self.get(n)
+
+	def __len__(self):
+		self.layout.wait_until_done()
+		return self.layout.laid_out()
+
+	def __iter__(self):
+		n = 0
+		while self.has(n):
+			yield self.get(n)
+			n += 1
+
 def split_text_into_words(text):
 # This function splits a string of text into words. It will return an array of strings that each contain one word
 	return re_word_break.split(text)
@@ -68,6 +450,193 @@ def split_text_into_words(text):
 #		i += 1
 #	return words
 
+re_single_newline = re.compile('(?<!\n)\n(?!\n)')	# A line break that isn't next to another one, which --merge-lines turns into a space
+
+def settled_length(text, merge_lines = False):
+# Returns the length of the start of <text> that more text coming after it can't change the words of: up to the end of its last line, or with <merge_lines>, to the end of its last run of two or more line breaks
+	if merge_lines:
+		p = text.rfind('\n\n', 0, len(text.rstrip('\n')))	# Not counting a run of line breaks at the end, which may carry on in what comes next
+		return p+2 if p >= 0 else 0
+	return text.rfind('\n')+1
+
+def iter_words(f, merge_lines = False, chunk_size = 1<<16):
+# Yields the words of the text read from the text file <f>, reading it <chunk_size> characters at a time. The words are the same as split_text_into_words() gives for the whole text with a newline added at the end if it doesn't already end with one. If <merge_lines> is True, single line breaks are first turned into spaces, as with book.py's --merge-lines option.
+# Each time, the text read so far is split up to its settled_length(), since how the words before there are split doesn't depend on what comes after
+	pending = ''
+	read_any = False
+	while True:
+		chunk = f.read(chunk_size)
+		if not chunk:
+			break
+		read_any = True
+		text = pending+chunk
+		cut = settled_length(text, merge_lines)
+		if cut:
+			part = text[:cut]
+			words = split_text_into_words(re_single_newline.sub(' ', part) if merge_lines else part)
+			words.pop()	# The blank word after the last line break, which is really the start of the rest
+			yield from words
+		pending = text[cut:]
+	if not read_any:
+		return
+	if merge_lines:
+		pending = re_single_newline.sub(' ', pending)
+	if pending and pending[-1] != '\n':
+		pending += '\n'
+	yield from split_text_into_words(pending)
+
+class BackgroundLoader:
+# The base of the loaders that read a book in a background thread, so that it can be shown while the rest of it is still being loaded: StreamLoader, epubtext's EpubLoader and compressed's CompressedLoader. <text> is the start of the book, which is there once the loader has been made, and poll() hands out the rest as it comes. A subclass starts the thread with _start(), and its _run() hands out each piece of text with _hand_out()
+	def __init__(self):
+		self.text = ''
+		self.done = False
+		self.error = None	# The exception, if loading the rest of the book failed
+		self._pending = []
+		self._lock = threading.Lock()
+		self._arrived = threading.Condition(self._lock)
+		self._thread = None
+
+	def _start(self, name, *args, wait_for_text = True):
+		# Runs _run(*args) in a background thread called <name>. With <wait_for_text>, waits for the first piece of text and makes it <text>
+		self._thread = threading.Thread(target=self._load, args=args, name=name, daemon=True)
+		self._thread.start()
+		if wait_for_text:
+			with self._lock:
+				while not self._pending and not self.done:
+					self._arrived.wait()
+			self.text = self.poll()[0]
+
+	def _load(self, *args):
+		try:
+			self._run(*args)
+		except Exception as e:
+			self.error = e
+		with self._lock:
+			self.done = True
+			self._arrived.notify_all()
+
+	def _run(self, *args):
+		raise NotImplementedError
+
+	def _hand_out(self, text):
+		with self._lock:
+			self._pending.append(text)
+			self._arrived.notify_all()
+
+	def poll(self):
+		# Returns the text loaded since <text> or the last call to poll() (or '' if there is none), and whether that is the end of the book
+		with self._lock:
+			more = ''.join(self._pending)
+			self._pending = []
+			return more, self.done
+
+	def loading(self):
+		# Returns whether there is more of the book still to come from poll()
+		with self._lock:
+			return not self.done or bool(self._pending)
+
+	def wait(self):
+		# Waits for the whole book to be loaded and returns all of its text
+		if self._thread is not None:
+			self._thread.join()
+		self.text += self.poll()[0]
+		if self.error is not None:
+			raise self.error
+		return self.text
+
+class StreamLoader(BackgroundLoader):
+# Reads a book from the binary file <f>, such as a pipe, in a background thread, so that it can be shown while the rest of it is still arriving (see BackgroundLoader). Text is only handed out up to its settled_length(), so that the words of what has been handed out don't change when more comes
+# f.read() should return whatever has arrived rather than wait for a whole chunk, as it does for unbuffered files. The text is decoded with <encoding> and <errors>
+	def __init__(self, f, encoding = 'utf-8', errors = 'strict', merge_lines = False, chunk_size = 1<<16):
+		super().__init__()
+		self._start('book-stream', f, codecs.getincrementaldecoder(encoding)(errors), merge_lines, chunk_size)
+
+	def _run(self, f, decoder, merge_lines, chunk_size):
+		pending = ''
+		while True:
+			data = f.read(chunk_size)
+			pending += decoder.decode(data, final=not data)
+			cut = settled_length(pending, merge_lines) if data else len(pending)
+			if cut:
+				self._hand_out(pending[:cut])
+				pending = pending[cut:]
+			if not data:
+				break
+
+# The same word breaks as re_word_break, but for the raw bytes of a UTF-8 file read in binary mode, where line breaks may be \r\n or \r and haven't been turned into \n. \S has to be spelled out since in a bytes pattern it doesn't exclude \x1c-\x1f or the non-ASCII whitespace characters
+b_after_nospace = b'(?:(?<=[\x00-\x08\x0e-\x1b!-\x7f])|(?<=[\x80-\xff])' + b''.join(b'(?<!' + re.escape(c.encode()) + b')' for c in '\x85\xa0\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000') + b')'	# The non-ASCII ones are only checked for after a non-ASCII byte
+b_single_newline = b'(?<![\r\n])(?:\r\n|\r(?!\n)|\n)(?![\r\n])'	# A line break that isn't next to another one, which --merge-lines turns into a space
+# Each alternative starts with a check of a single character that fails at most places in a book, so that the long lookbehinds are only tried where there could be a break: this makes opening a book about twice as quick
+re_b_word_break = re.compile(b'(?=[ \t])' + b_after_nospace + b'[ \t]+|(?<=[\r\n])(?:(?<=\n)|(?!\n))')
+re_b_word_break_merged = re.compile(b'(?=[ \t\r\n])' + b_after_nospace + b'(?:[ \t]|' + b_single_newline + b')+|(?<=[\r\n])(?:(?<=\n)(?=[\r\n])|(?<=\n\n)|(?<=[\r\n]\r\n)|(?<=\r)(?=\r)|(?<=[\r\n]\r)(?!\n))')
+re_newline = re.compile('\r\n?')
+re_any_newline = re.compile('\r\n|\r|\n')
+
+class MappedWords:
+# A read-only list of the words in a UTF-8 text file, without reading the file into memory or making a string for every word. The file is memory-mapped and the start and end of each word are kept as byte offsets in an array; a word is only decoded when it is asked for.
+# The words are the same as split_text_into_words() would give for the file read in text mode, with a newline added at the end if it doesn't already end with one. If <merge_lines> is True, single line breaks are first turned into spaces, as with book.py's --merge-lines option.
+	def __init__(self, filename, merge_lines = False):
+		with open(filename, 'rb') as f:
+			self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		self.merge_lines = merge_lines
+		size = len(self.data)
+		self.bounds = array('I' if size < 1<<32 else 'Q', [0])	# Word n runs from bounds[2n] to bounds[2n+1]
+		self.bounds.extend(chain.from_iterable(map(re.Match.span, (re_b_word_break_merged if merge_lines else re_b_word_break).finditer(self.data))))
+		self.bounds.append(size)
+		self.add_newline = not (size and self.data[size-1] in b'\r\n' and not self._merged_newline(size))
+		if self.add_newline:	# Adding a newline puts a word break after it, so there is an extra blank word at the end
+			self.bounds.extend((size, size))
+
+	def _merged_newline(self, end):
+	# Returns True if the line break that ends at byte <end> is one that merge_lines turns into a space
+		if not self.merge_lines:
+			return False
+		start = end-2 if self.data[end-2:end] == b'\r\n' else end-1
+		return not ((end < len(self.data) and self.data[end] in b'\r\n') or (start > 0 and self.data[start-1] in b'\r\n'))
+
+	def __len__(self):
+		return len(self.bounds)//2
+
+	def __getitem__(self, n):
+		if isinstance(n, slice):
+			return [self[i] for i in range(*n.indices(len(self)))]
+		if n < 0:
+			n += len(self)
+		if not 0 <= n < len(self):
+			raise IndexError('word index out of range')
+		start, end = self.bounds[2*n:2*n+2]
+		raw = self.data[start:end]
+		word = raw.decode('utf-8', 'replace')
+		if b'\r' in raw or (self.merge_lines and b'\n' in raw):
+			word = self._fix_newlines(word, end)
+		if self.add_newline and n == len(self)-2:
+			word += '\n'
+		return word
+
+	def __iter__(self):	# The same as going through __getitem__ for each word, but quicker
+		data = self.data
+		merge_lines = self.merge_lines
+		last = len(self)-2 if self.add_newline else -1
+		bounds = iter(self.bounds)
+		for n, (start, end) in enumerate(zip(bounds, bounds)):
+			raw = data[start:end]
+			word = raw.decode('utf-8', 'replace')
+			if b'\r' in raw or (merge_lines and b'\n' in raw):
+				word = self._fix_newlines(word, end)
+			if n == last:
+				word += '\n'
+			yield word
+
+	def _fix_newlines(self, word, end):
+	# Turns the line breaks in <word>, which ends at byte <end>, into what they would have become in text mode and with merge_lines
+		if not self.merge_lines:
+			return re_newline.sub('\n', word)
+		last = ''
+		if word[-1] in '\r\n' and not self._merged_newline(end):	# Only a word's last line break can be a real one; the rest are all merged
+			last = '\n'
+			word = word[:-2] if word.endswith('\r\n') else word[:-1]
+		return re_any_newline.sub(' ', word) + last
+
 def get_word_and_indent(word):
 	# If <word> is a string containing a word that may be preceeded by whitespace, this function extracts the word and returns the number of spaces to indent in the output (equal to the number of leading whitespace characters / indent_in, rounded up, all multiplied by indent_out). Returns a 2-tuple of the word and indent as an integer. Used by justify_words to handle indenting
 	start_match = re_nospace.search(word)
@@ -79,18 +648,33 @@ def get_word_and_indent(word):
 	else:
 		return '', 0
 
-def justify_words(words, width, start_word = 0, min_width = 1, max_lines = None, start_indent = 0):
+def get_skip(word, head):
+	# Returns how many characters have been taken off the start of <word> to leave <head>, or <head> itself if it isn't what's left of <word>. Used by justify_words to report where the next page starts
+	skip = len(word)-len(head)
+	if skip >= 0 and word[skip:] == head:
+		return skip
+	return head
+
+no_skip = 0xffffffff	# Stands for a skip that is the leftover text rather than a number, where only numbers can be kept
+
+def skip_number(skip):
+	return skip if isinstance(skip, int) else no_skip
+
+def justify_words(words, width, start_word = 0, min_width = 1, max_lines = None, start_indent = 0, start_skip = 0, line_starts = None):
 # This funciton goes through a list of words and assembles them into a page of justified lines of the specified width (<width>) and height (<max_lines>).
-# words: list of words, some of which will be assembled into a justified page
+# words: list of words, some of which will be assembled into a justified page. The list is not modified, so the same words can be laid out again at another size
 # width: width of the page, in characters
 # start_word: index of the first word to start the page with
 # min_width: minimum line width; if moving a word to the next line would make the current line less than this, then the word will be broken up and hyphenated instead
 # max_lines: height of the page, in lines
 # start_indent: initial indent level to start at; should pass in the 4th value returned by the previous page's call
-# Returns a 3-tuple of the formatted page, the number of lines that were put onto the page, the index (in <words>) of the next word after the end of the page, and the indent level left off at (so that in-paragraph indent will persist when the paragraph is split between pages)
+# start_skip: number of characters at the start of words[start_word] that were already used up by the previous page (by hyphenating or stripping indent); should pass in the 5th value returned by the previous page's call. In rare cases (hyphenating a word made only of indent) what is left over isn't part of the word any more, and this is the leftover text itself instead
+# line_starts: if given, an array (or list) that the index of the first word on each line of the page, the column it starts at, and 1 if the line starts part way through that word (with the rest of a hyphenated word, or for the first line, after <start_skip>) or else 0, are appended to (three numbers per line)
+# Returns a 5-tuple of the formatted page, the number of lines that were put onto the page, the index (in <words>) of the next word after the end of the page, the indent level left off at (so that in-paragraph indent will persist when the paragraph is split between pages), and how much of that next word has already been used (see start_skip)
 	out_text = ''
 	total_width = 0
 	this_line = []
+	line_word = start_word	# Index of the first word in this_line
 	n_lines = 0
 	new_para = True
 	i = start_word
@@ -98,53 +682,383 @@ def justify_words(words, width, start_word = 0, min_width = 1, max_lines = None,
 	eff_indent = min(indent, width-3)
 	width_with_indent = width-eff_indent
 	indent_spaces = ' '*eff_indent
+	head_i = -1	# Rather than changing <words>, the current text of a word that has been hyphenated or had its indent stripped is kept in <head>, and <head_i> is its index
+	head = ''
+	rest_i = start_word if start_skip else -1	# The index of the word the next line starts part way through, if any
 	if i < len(words):
-		words[i] = words[i].lstrip('\r\n')
-		words[i] = ' '*(start_indent*indent_in//indent_out)+words[i]  # If we have a starting indent from the previous call, we add 'fake' indent spaces to the first word, which will then be caught by the new_para code
+		head_i = i
+		head = ' '*(start_indent*indent_in//indent_out)+(words[i][start_skip:] if isinstance(start_skip, int) else start_skip).lstrip('\r\n')  # If we have a starting indent from the previous call, we add 'fake' indent spaces to the first word, which will then be caught by the new_para code
 	while i < len(words):
-		word = words[i]
+		word = head if i == head_i else words[i]
 		if not word:	# A 'blank' word indicates multiple consective spaces in the input. Ignore.
 			i += 1
 			continue
 		if new_para: # Start of a new paragraph; check if this paragraph has an indent and set variables accordingly
-			words[i], indent = get_word_and_indent(words[i])
-			if words[i]:
-				word = words[i]
+			head, indent = get_word_and_indent(word)
+			head_i = i
+			if head:
+				word = head
 			eff_indent = min(indent, width-3)
 			width_with_indent = width-eff_indent
 			indent_spaces = ' '*eff_indent
 			new_para = False
+		if not this_line:
+			line_word = i
 		new_total_width = total_width + len(word)+1
 		if new_total_width <= width_with_indent:	# Adding this word to the line won't put it over the column width, so just add it
 			this_line += [word]
 			total_width = new_total_width
 			if word[-1] == '\n':	# This is the last word in the paragraph so deal with that
 				n_lines += 1
+				if line_starts is not None:
+					line_starts.extend((line_word, eff_indent, line_word == rest_i))
 				out_text += indent_spaces+justify_line(this_line, total_width-len(this_line), width_with_indent)
 				if max_lines and n_lines > max_lines-1:
-					return (out_text, n_lines, i+1, 0)
+					return (out_text, n_lines, i+1, 0, 0)
 				total_width = 0
 				this_line = []
 				new_para = True
 		else:	# Adding this word would put it over the column width; start a new line 
 			n_lines += 1
 			if max_lines and n_lines > max_lines-1:  # We've filled up the page, return the completed page
+				if line_starts is not None and this_line:
+					line_starts.extend((line_word, eff_indent, line_word == rest_i))
 				jl = indent_spaces+justify_line(this_line, total_width-len(this_line), width_with_indent)
 				out_text += jl
-				return (out_text, n_lines, i, indent)
+				return (out_text, n_lines, i, indent, get_skip(words[i], head) if i == head_i else 0)
+			line_rest = line_word == rest_i
 			if(total_width < (min_width or 1)):	# We need to break this word up with a hyphen
 				break_pt = width_with_indent-2-total_width
 				firsthalf = word[:break_pt]
 				rest = word[break_pt:]
 				this_line += [firsthalf+'-']
 				total_width = width_with_indent
-				#words.insert(i+1, rest)
-				words[i] = rest
+				head_i = i
+				head = rest
+				rest_i = i
 			i -= 1
+			if line_starts is not None and this_line:
+				line_starts.extend((line_word, eff_indent, line_rest))
 			jl = indent_spaces+justify_line(this_line, total_width-len(this_line), width_with_indent)
 			out_text += jl
 			total_width = 0
 			this_line = []
 		i+=1
+	if line_starts is not None and this_line:
+		line_starts.extend((line_word, eff_indent, line_word == rest_i))
 	out_text += indent_spaces+justify_line(this_line, total_width-len(this_line), width_with_indent)
-	return (out_text, n_lines, i, indent)  # We've reached the end of the input text, return the completed page
+	return (out_text, n_lines, i, indent, 0)  # We've reached the end of the input text, return the completed page
+
+word_sep = '\x00'	# Joins words to look for paragraph ends in all of them at once
+re_joined_para_end = re.compile('\n(?=\x00|\\Z)')
+
+def paragraph_ends(words, base = 0):
+# Yields the index (plus <base>) of each of the list <words> that ends with a newline. Rather than looking at every word, the words are joined with word_sep and only the newlines are looked at, which takes about a third of the time
+	joined = word_sep.join(words)
+	if joined.count(word_sep) != len(words)-1:	# Some word has word_sep in it
+		yield from compress(count(base), map(str.endswith, words, repeat('\n')))
+		return
+	n = base
+	last = 0
+	for match in re_joined_para_end.finditer(joined):
+		n += joined.count(word_sep, last, match.start())
+		last = match.start()
+		yield n
+
+class WordMetrics:
+# The widths of a list of words, worked out once so that justify_words_fast() can find where lines break without going through the words one at a time.
+# Working them out takes about as long as finding the page ends with them does: for a 3MB book, about 0.15s, against 0.1-0.2s for the page ends and 0.4-0.5s for justify_words() (smaller pages being the slower). So a first layout is only about 1.4-1.7 times as quick as with justify_words(); the real gain is in laying the same words out again at another size, which reuses the metrics and is 2.5-4 times as quick
+# lens: the length of each word
+# cum: cum[n] is the width taken up by words 0 to n-1, counting a space after each word (blank words, which are skipped, take up nothing)
+# para_ends: the indexes of the words that end a paragraph (end with a newline), in order, and then the number of words
+# If <base> is given, it is the WordMetrics of an earlier list of words whose first <n_same> words are the same as those of <words> (which must be a list), and only the words after those are measured
+	def __init__(self, words, base = None, n_same = 0):
+		self.words = words
+		if base is None:
+			n_same = 0
+			self.lens = array('I')
+			self.para_ends = array('I')
+			self.cum = array('Q', [0])
+		else:
+			self.lens = base.lens[:n_same]
+			self.para_ends = base.para_ends[:bisect_left(base.para_ends, n_same)]
+			self.cum = base.cum[:n_same+1]
+		if isinstance(words, list):
+			new = words[n_same:] if n_same else words
+			self.lens.extend(map(len, new))
+			self.para_ends.extend(paragraph_ends(new, n_same))
+		else:	# Only go through the words once, since getting each one may take some work (as for MappedWords)
+			for n, word in enumerate(words):
+				self.lens.append(len(word))
+				if word[-1:] == '\n':
+					self.para_ends.append(n)
+		new_lens = self.lens[n_same:] if n_same else self.lens
+		self.cum.extend(islice(accumulate(map(add, new_lens, map(bool, new_lens)), initial=self.cum[-1]), 1, None))
+		self.para_ends.append(len(self.lens))	# So that there is always a next paragraph end
+
+def justify_words_fast(metrics, width, start_word = 0, min_width = 1, max_lines = None, start_indent = 0, start_skip = 0, render = True, line_starts = None, breaks = None):
+# Does the same as justify_words(), and gives exactly the same results, but works a line at a time instead of a word at a time: the words that fit on a line are found by bisecting metrics.cum, and each line is put together with one join.
+# metrics: the WordMetrics of the list of words to lay out
+# render: if False, only work out where the page ends and return '' instead of the page's text, which is much quicker (and <line_starts> isn't filled in)
+# breaks: if given, an array that four numbers are appended to for each line: the next word, indent and skip that would be returned if the page ended after that line, and the skip the next line actually starts with (which is different if the next word was hyphenated). A skip that isn't a number is given as no_skip
+# The rest of the arguments and the return value are the same as for justify_words()
+	words = metrics.words
+	cum = metrics.cum
+	if not render:
+		line_starts = None
+	para_ends = metrics.para_ends
+	n_words = len(metrics.lens)
+	para_k = bisect_left(para_ends, start_word)	# para_ends[para_k] is the end of the paragraph the current line is in
+	out_lines = []
+	line = []
+	total_width = 0
+	n_lines = 0
+	new_para = True
+	i = start_word
+	indent = start_indent
+	eff_indent = min(indent, width-3)
+	width_with_indent = width-eff_indent
+	indent_spaces = ' '*eff_indent
+	head_i = -1	# As in justify_words(), the current text of a word that has been hyphenated or had its indent stripped
+	head = ''
+	rest_i = start_word if start_skip else -1	# As in justify_words(), the word the next line starts part way through
+	if i < n_words:
+		head_i = i
+		head = ' '*(start_indent*indent_in//indent_out)+(words[i][start_skip:] if isinstance(start_skip, int) else start_skip).lstrip('\r\n')
+	while i < n_words:	# Each time round the loop lays out one line, starting with word i
+		while para_ends[para_k] < i:
+			para_k += 1
+		if i == head_i or new_para:
+			word = head if i == head_i else words[i]
+			if not word:
+				i += 1
+				continue
+			if new_para:
+				head, indent = get_word_and_indent(word)
+				head_i = i
+				if head:
+					word = head
+				eff_indent = min(indent, width-3)
+				width_with_indent = width-eff_indent
+				indent_spaces = ' '*eff_indent
+				new_para = False
+			first_width = len(word)+1
+			ends_para = word[-1] == '\n'
+		else:	# Most lines start with a word that hasn't been changed, so its width is already known and the text isn't needed unless we're rendering
+			word = None
+			first_width = cum[i+1]-cum[i]
+			if not first_width:
+				i += 1
+				continue
+			ends_para = para_ends[para_k] == i
+		if first_width > width_with_indent:	# Not even the first word fits
+			line = []
+			total_width = 0
+			end = i
+			last_line = False
+		elif ends_para:
+			line = [word if word is not None else words[i]]
+			end = i+1
+			last_line = True
+		else:
+			max_width = cum[i+1]+width_with_indent-first_width
+			hi = i+2+width_with_indent//2	# Every word takes up at least 2, unless there are blank words
+			if hi > n_words:
+				hi = n_words+1
+			end = bisect_right(cum, max_width, i+1, hi)-1	# The words after the first one, up to but not including word <end>, fit on the line
+			if end == hi-1 and hi <= n_words:
+				end = bisect_right(cum, max_width, hi)-1
+			para_end = para_ends[para_k+1] if para_ends[para_k] == i else para_ends[para_k]
+			last_line = para_end < end
+			if last_line:
+				end = para_end+1
+			total_width = first_width+cum[end]-cum[i+1]
+			if render:
+				if word is None:
+					line = words[i:end]
+				else:
+					line = words[i+1:end]
+					line.insert(0, word)
+				if '' in line:
+					line = [w for w in line if w]
+		if last_line:
+			n_lines += 1
+			if breaks is not None:
+				breaks.extend((end, 0, 0, 0))
+			if render:
+				out_lines.append(indent_spaces+' '.join(line))
+				if line_starts is not None:
+					line_starts.extend((i, eff_indent, i == rest_i))
+			if max_lines and n_lines > max_lines-1:
+				return (''.join(out_lines), n_lines, end, 0, 0)
+			new_para = True
+			i = end
+			continue
+		if end == n_words:	# We've reached the end of the input text part way through a line
+			break
+		n_lines += 1	# Word <end> doesn't fit; start a new line
+		if max_lines and n_lines > max_lines-1:  # We've filled up the page, return the completed page
+			if render:
+				out_lines.append(indent_spaces+justify_line(line, total_width-len(line), width_with_indent))
+				if line_starts is not None and line:
+					line_starts.extend((i, eff_indent, i == rest_i))
+			return (''.join(out_lines), n_lines, end, indent, get_skip(words[end], head) if end == head_i else 0)
+		if breaks is not None:
+			skip = skip_number(get_skip(words[end], head)) if end == head_i else 0
+		line_rest = i == rest_i
+		if(total_width < (min_width or 1)):	# We need to break word <end> up with a hyphen
+			if end != i or word is None:
+				word = words[end]
+			break_pt = width_with_indent-2-total_width
+			if render:
+				line.append(word[:break_pt]+'-')
+			total_width = width_with_indent
+			head_i = end
+			head = word[break_pt:]
+			rest_i = end
+		if breaks is not None:
+			breaks.extend((end, indent, skip, skip_number(get_skip(words[end], head)) if end == head_i else 0))
+		if render:
+			out_lines.append(indent_spaces+justify_line(line, total_width-len(line), width_with_indent))
+			if line_starts is not None and line:
+				line_starts.extend((i, eff_indent, line_rest))
+		i = end
+	else:
+		line = []
+		total_width = 0
+	if render:
+		out_lines.append(indent_spaces+justify_line(line, total_width-len(line), width_with_indent))
+		if line_starts is not None and line:
+			line_starts.extend((i, eff_indent, i == rest_i))
+	return (''.join(out_lines), n_lines, n_words, indent, 0)  # We've reached the end of the input text, return the completed page
+
+parallel_min_words = 100000	# Books with fewer words than this are laid out in one process, as starting the pool would take longer
+chunks_per_worker = 4	# The book is cut into this many chunks for each worker process, so that they all finish at about the same time
+
+def pool_map(function, *iterables, workers = None, chunksize = 1):
+# Yields function(*args) for each set of arguments taken from <iterables>, in order, working them out in a pool of <workers> processes (one per CPU by default), which are handed <chunksize> sets at a time. If there is no working process pool, or only one worker, they are worked out in this process instead
+	calls = list(zip(*iterables))
+	done = 0
+	if (workers or os.cpu_count() or 1) > 1 and len(calls) > 1:
+		from concurrent.futures import ProcessPoolExecutor	# Imported here as it takes longer than the rest of startup, and most books never need it
+		from concurrent.futures.process import BrokenProcessPool
+		try:
+			pool = ProcessPoolExecutor(workers)
+			try:
+				for result in pool.map(function, *zip(*calls), chunksize=chunksize):
+					done += 1
+					yield result
+				return
+			finally:
+				pool.shutdown(wait=False, cancel_futures=True)
+		except (OSError, NotImplementedError, BrokenProcessPool):
+			pass	# No working process pool on this system; do the rest here instead
+	for args in calls[done:]:
+		yield function(*args)
+
+def paragraph_cuts(words, n_chunks):
+# Returns the word numbers to cut <words> into about <n_chunks> chunks at, starting with 0 and ending with len(words). Every chunk but the first starts with the first word of a paragraph that isn't blank and doesn't start with a line break, so that justify_words() starting there lays it out the same way as it would if it had carried on from the previous paragraph
+	n_words = len(words)
+	cuts = [0]
+	step = max(1, n_words//n_chunks)
+	for target in range(step, n_words, step):
+		k = max(target, cuts[-1]+1)
+		while k < n_words and not (words[k-1][-1:] == '\n' and words[k][:1] not in ('', '\r', '\n')):
+			k += 1
+		if k >= n_words:
+			break
+		cuts.append(k)
+	cuts.append(n_words)
+	return cuts
+
+def break_lines(words, base, width, min_width):
+# Breaks <words>, which are the words of a book from word number <base> on, into lines as if they were all one page. Run in the worker processes for parallel_page_ends(). Returns the array filled in by justify_words_fast()'s <breaks> (with <base> added to the word numbers), and the indent left off at
+	breaks = array('I')
+	indent = justify_words_fast(WordMetrics(words), width, 0, min_width, render=False, breaks=breaks)[3]
+	if base:
+		breaks[0::4] = array('I', map(add, breaks[0::4], repeat(base)))
+	return breaks, indent
+
+def restarts_in_step(words, word_n, skip, indent):
+# Returns the word number at which a page that starts at word <word_n> (with <skip> and <indent> as from the previous page) lays its lines out the same way as they would be laid out if they carried on from the line before, or None if it doesn't. Pages start by taking the indent off their first word and working it out again, and by dropping line breaks at the start of the page, so this is only the case when neither of those changes anything
+	if not isinstance(skip, int) or word_n >= len(words):
+		return None
+	if skip == 0 and (word_n == 0 or words[word_n-1][-1:] == '\n'):	# It starts a paragraph, so only the line breaks matter
+		word = words[word_n]
+		if word[:1] in ('\r', '\n'):
+			if word.lstrip('\r\n'):
+				return None
+			return word_n+1	# A blank line at the top of a page is dropped
+		return word_n
+	if re_nospace.match(words[word_n], skip) and indent_out*ceil((indent*indent_in//indent_out)/indent_in) == indent:
+		return word_n
+	return None
+
+def parallel_page_ends(words, width, lines, min_width = 1, workers = None):
+# Yields where each page of <words> ends, as a tuple of the word number, how much of that word has been used up and the indent carried over (the 3rd, 5th and 4th values returned by justify_words()), for the same pages as split_words_into_pages(). Most of the work is done in a pool of <workers> processes (one per CPU by default).
+# Apart from the indent, line breaking starts afresh at each paragraph, so the book is cut into chunks at paragraph breaks and the chunks are broken into lines in parallel (see break_lines()). Counting off pages from those lines is then quick. The first line of a page can come out differently from the same line in the middle of a page, though (see restarts_in_step()), and a page that does is laid out here with justify_words() instead, until the pages get back in step with the chunks' lines
+	n_words = len(words)
+	n_workers = workers or os.cpu_count() or 1
+	cuts = paragraph_cuts(words, n_workers*chunks_per_worker)
+	results = pool_map(break_lines, [words[a:b] for a, b in zip(cuts, cuts[1:])], cuts, repeat(width), repeat(min_width), workers=workers)
+	ends = array('I')	# For each line of the chunks, the next word, indent and skip that a page ending after it would end with...
+	indents = array('I')
+	skips = array('I')
+	nexts = array('I')	# ...and the skip the next line starts with
+	final_indent = 0
+	def more():
+		# Adds the lines of the next chunk. Returns False if there are none left
+		nonlocal final_indent
+		for breaks, final_indent in results:
+			ends.extend(breaks[0::4])
+			indents.extend(breaks[1::4])
+			skips.extend(breaks[2::4])
+			nexts.extend(breaks[3::4])
+			return True
+		return False
+	def in_step(word_n, skip, indent):
+		# Returns the number of lines of the chunks that come before a page starting at word <word_n>, if it lays out the same lines as the chunks from there on, or else None
+		word_n = restarts_in_step(words, word_n, skip, indent)
+		if word_n is None:
+			return None
+		while (not ends or ends[-1] <= word_n) and more():
+			pass
+		k = bisect_left(ends, word_n)
+		while k < len(ends) and ends[k] == word_n:
+			if nexts[k] == skip and indents[k] == indent:
+				return k+1
+			k += 1
+		return None
+	try:
+		word_n = skip = indent = 0
+		pos = 0	# The number of lines of the chunks before the current page, or None if it isn't in step with them
+		while word_n < n_words:
+			if pos is not None:
+				last = pos+lines-1	# The page's last line
+				while len(ends) <= last and more():
+					pass
+				if last < len(ends) and skips[last] != no_skip:
+					word_n, skip, indent = ends[last], skips[last], indents[last]
+				elif last >= len(ends) > pos:	# The book ends on this page
+					word_n, skip, indent = n_words, 0, final_indent
+				else:
+					pos = None
+			if pos is None:
+				_, _, word_n, indent, skip = justify_words(words, width, word_n, min_width, lines, indent, skip)
+			yield word_n, skip, indent
+			pos = in_step(word_n, skip, indent) if word_n < n_words else None
+	finally:
+		results.close()
+
+def render_pages(words, base, starts, width, lines, min_width, line_tables):
+# Returns the text of the pages that start at each of <starts> (tuples of the word number, skip and indent, as from parallel_page_ends()), given the <words> of the book from word number <base> up to the end of the last of them, and a list of their line tables if <line_tables> is True (or else an empty one). Run in the worker processes for split_words_into_pages()
+	pages = []
+	tables = []
+	for word_n, skip, indent in starts:
+		table = array('I') if line_tables else None
+		pages.append(justify_words(words, width, word_n-base, min_width, lines, indent, skip, line_starts=table)[0])
+		if line_tables:
+			if base:
+				table[0::3] = array('I', map(add, table[0::3], repeat(base)))
+			tables.append(table)
+	return pages, tables
@@ -0,0 +1,127 @@
+import gc
+import os
+import sys
+import zlib
+from collections import OrderedDict
+from os import path
+
+from libjust import MappedWords, LayoutCancelled
+from compressed import CompressedWords
+
+# Library mode: several books open in the one reader, switched between with a key. The books that aren't being read are kept open, with their text, words and layout, so that switching back to one is instant, as long as they all fit in a memory limit. Past that, the least recently read are cut down to a CompactBook: the reading position, the finished layout as PageLayout.dump() bytes, and the text compressed if it can't just be read from the file again.
+
+word_overhead = 57	# Bytes taken up by each word in a list of words, besides its characters: the str object and the list's pointer to it
+
+def library_files(paths):
+	# Returns the books to open for the files and directories in <paths>: files as they are, and then the files in each directory, sorted by name and leaving out hidden ones (such as bookmarks)
+	files = []
+	for name in paths:
+		if path.isdir(name):
+			files += sorted(path.join(name, entry) for entry in os.listdir(name) if not entry.startswith('.') and path.isfile(path.join(name, entry)))
+		else:
+			files.append(name)
+	return files
+
+def book_memory(text, layout):
+	# Returns roughly how many bytes the book <text> and its PageLayout <layout> take up
+	if isinstance(text, MappedWords):
+		size = len(text.data) + text.bounds.itemsize*len(text.bounds)	# The mapped file counts, as having been read through it is resident
+	elif isinstance(text, CompressedWords):	# Only the regions it has decompressed hold any words
+		size = len(text.data) + sum(len(words)*word_overhead + sum(map(len, words)) for words in text.cached())
+	else:
+		size = sys.getsizeof(text)
+		if layout is not None:	# Its words, which between them hold another copy of the text
+			size += len(layout.words)*word_overhead + size
+	if layout is not None:
+		if layout.metrics is not None:
+			size += sum(a.itemsize*len(a) for a in (layout.metrics.lens, layout.metrics.cum, layout.metrics.para_ends))
+		size += layout.laid_out()*12
+	return size
+
+class OpenBook:
+# A book that is open but not being read: what book.py's load_book() sets up for it (text, loader, save, savename and text_hash), its PageLayout, and the word at the reading position and the one last saved as its bookmark
+	def __init__(self, name, text, loader, save, savename, text_hash, layout, word, saved_word):
+		self.name = name
+		self.text = text
+		self.loader = loader
+		self.save = save
+		self.savename = savename
+		self.text_hash = text_hash
+		self.layout = layout
+		self.word = word
+		self.saved_word = saved_word
+
+	def memory(self):
+		return book_memory(self.text, self.layout)
+
+	def compact(self):
+		# Returns the CompactBook to keep in place of this one, stopping its layout if it hasn't finished
+		try:
+			saved = self.layout.dump() if self.layout is not None and self.layout.done else None
+		except LayoutCancelled:
+			saved = None
+		if self.layout is not None:
+			self.layout.cancel()
+		packed = None
+		if isinstance(self.text, str) and not (self.loader and self.loader.loading()):	# An epub book's text, which would take a long time to get from the file again
+			packed = zlib.compress(self.text.encode('utf-8', 'surrogatepass'))
+		return CompactBook(self.word, self.saved_word, self.text_hash, saved and (self.layout.width, self.layout.lines, saved), packed)
+
+class CompactBook:
+# What is left of an OpenBook once it has been pushed out of memory
+# word, saved_word, text_hash: as for OpenBook
+# layout: the width and height of its finished layout and its dump(), or None
+# packed: its text compressed with zlib, or None if it is to be read from the file again
+	def __init__(self, word, saved_word, text_hash, layout, packed):
+		self.word = word
+		self.saved_word = saved_word
+		self.text_hash = text_hash
+		self.layout = layout
+		self.packed = packed
+
+	def text(self):
+		return zlib.decompress(self.packed).decode('utf-8', 'surrogatepass') if self.packed is not None else None
+
+class Library:
+# The books <files>, with those that aren't being read kept as OpenBooks, the least recently read first, or as CompactBooks once the OpenBooks would go over <memory_limit> bytes
+	def __init__(self, files, memory_limit):
+		self.files = files
+		self.memory_limit = memory_limit
+		self.open = OrderedDict()
+		self.compact = {}
+		self.recent = []	# The names of the books in the order they were last read, the most recent last
+
+	def put(self, book):
+		# Keeps the OpenBook <book>, which is no longer being read
+		self.open[book.name] = book
+		self.open.move_to_end(book.name)
+
+	def take(self, name):
+		# Returns the OpenBook kept for the file <name> or else its CompactBook (or None, None if it hasn't been opened yet), and forgets them, as it is about to be read
+		return self.open.pop(name, None), self.compact.pop(name, None)
+
+	def reading(self, name):
+		# Notes that the file <name> is now the one being read
+		self.recent = [other for other in self.recent if other != name] + [name]
+
+	def last_read(self):
+		# Returns the name of the book read before the current one, or None
+		return self.recent[-2] if len(self.recent) > 1 else None
+
+	def unsaved(self, bookmark_file):
+		# Returns the bookmark file name (from the function <bookmark_file>, given a book's file name) and reading position of each book that isn't being read whose position has moved since its bookmark was last saved
+		books = [(name, book) for name, book in self.open.items() if book.save] + list(self.compact.items())
+		return [(book.savename if isinstance(book, OpenBook) else bookmark_file(name), book.word) for name, book in books if book.word != book.saved_word]
+
+	def trim(self, in_use):
+		# Cuts the least recently read OpenBooks down to CompactBooks until they fit in what is left of the memory limit besides <in_use> bytes
+		sizes = {name: book.memory() for name, book in self.open.items()}
+		total = sum(sizes.values())
+		trimmed = False
+		while self.open and total+in_use > self.memory_limit:
+			name, book = self.open.popitem(last=False)
+			total -= sizes[name]
+			self.compact[name] = book.compact()
+			trimmed = True
+		if trimmed:
+			gc.collect()	# A PageLayout and its pages refer to each other, so its words would otherwise wait for the cycle collector's rare full collections
@@ -0,0 +1,61 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Opt-in timing instrumentation, turned on with book.py's --profile FILE or the BOOK_PROFILE environment variable. Each timed event is written to the file as one line of JSON, e.g.
+#	{"t": 1.532, "event": "render", "ms": 0.84, "page": 12}
+# where t is seconds since the program started and ms is how long the event took, and the most recent timings of each kind of event are kept so that percentiles can be shown while reading. When profiling is off, record() and timed() do nothing.
+
+env_var = 'BOOK_PROFILE'
+window = 500	# Number of recent timings of each event kept for percentiles
+
+log = None
+started = time.perf_counter()
+recent = {}
+lock = threading.Lock()	# Layouts finish in their worker threads
+
+def start(filename):
+	# Starts appending timings to the file <filename>. Raises OSError if it can't be opened
+	global log
+	log = open(filename, 'a', buffering=1)
+
+def enabled():
+	return log is not None
+
+def record(event, seconds, **fields):
+	# Logs that <event> took <seconds>, along with any extra <fields> (which must be JSON-serializable)
+	if log is None:
+		return
+	line = {'t': round(time.perf_counter()-started, 6), 'event': event, 'ms': round(seconds*1000, 3)}
+	line.update(fields)
+	with lock:
+		recent.setdefault(event, deque(maxlen=window)).append(seconds)
+		try:
+			log.write(json.dumps(line)+'\n')
+		except (OSError, ValueError):
+			pass	# Don't let a full disk take the reader down with it
+
+@contextmanager
+def timed(event, **fields):
+	# Times the body of a with statement as <event>. Yields the dict of fields to log, so that the body can add to it
+	start = time.perf_counter()
+	try:
+		yield fields
+	finally:
+		record(event, time.perf_counter()-start, **fields)
+
+def percentile(samples, p):
+	ordered = sorted(samples)
+	return ordered[min(len(ordered)-1, int(len(ordered)*p/100))]
+
+def format_ms(seconds):
+	ms = seconds*1000
+	return '%.0f'%ms if ms >= 100 else '%.1f'%ms if ms >= 1 else '%.2f'%ms
+
+def summary(events = ('key', 'render', 'layout', 'tokenize', 'search')):
+	# Returns a one-line summary of the recent p50/p99 timings of <events>, for the status line
+	with lock:
+		parts = ['%s %s/%s'%(event, format_ms(percentile(recent[event], 50)), format_ms(percentile(recent[event], 99))) for event in events if recent.get(event)]
+	return 'p50/p99 ms: '+('  '.join(parts) if parts else 'nothing timed yet')
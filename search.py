@@ -0,0 +1,120 @@
+import threading
+import string
+from array import array
+from bisect import bisect_left
+from itertools import islice
+
+# Full-text search over the words of a book. A SearchIndex builds a map from each search term to the numbers of the words it appears at, in a background thread, a chunk of words at a time. Searches look terms up in whatever part of the book has been indexed so far and scan through the words of the rest, so they work straight away and get faster once the index is ready.
+# A search term is a word with the punctuation around it taken off, case-folded, so that "Whale," matches a search for whale. A query of several words matches them as a phrase.
+
+strip_chars = string.whitespace + string.punctuation + '“”‘’«»„—–…\xa0'
+chunk_size = 50000	# Words indexed between each update of the index
+
+def term_of(word):
+	return word.strip(strip_chars).casefold()
+
+def query_terms(query):
+	# Returns the list of search terms in <query>
+	return [term for term in map(term_of, query.split()) if term]
+
+class SearchIndex:
+# words: list of words (as from split_text_into_words() or MappedWords) to index. The word numbers returned by find() are indexes into it, so they can be passed to find_page_with_word()
+	def __init__(self, words):
+		self.indexed = 0	# Words before this have been indexed
+		self.done = False
+		self._positions = {}
+		self._lock = threading.Lock()
+		self._cancelled = False
+		self._thread = threading.Thread(target=self._run, args=(words,), name='book-search-index', daemon=True)
+		self._thread.start()
+
+	def _run(self, words):
+		it = iter(words)
+		n = 0
+		while not self._cancelled:
+			chunk = {}
+			start = n
+			for term in map(term_of, islice(it, chunk_size)):
+				if term:
+					positions = chunk.get(term)
+					if positions is None:
+						chunk[term] = [n]
+					else:
+						positions.append(n)
+				n += 1
+			with self._lock:
+				for term, positions in chunk.items():
+					found = self._positions.get(term)
+					if found is None:
+						self._positions[term] = array('I', positions)
+					else:
+						found.extend(positions)
+				self.indexed = n
+			if n-start < chunk_size:
+				self.done = True
+				break
+
+	def cancel(self):
+		self._cancelled = True
+
+	def find(self, words, query, start, backward = False):
+	# Returns the number of the first word of the next match for <query> in <words> (the same words the index was built from) at or after word <start>, or the last one before it if <backward>, wrapping round at the end (or start) of the book. Returns None if there is no match
+		terms = query_terms(query)
+		if not terms:
+			return None
+		n_words = len(words)
+		start = max(0, min(start, n_words))
+		if backward:
+			ranges = ((0, start), (start, n_words))
+		else:
+			ranges = ((start, n_words), (0, start))
+		for lo, hi in ranges:
+			match = self._find_in(words, terms, lo, hi, backward)
+			if match is not None:
+				return match
+		return None
+
+	def _find_in(self, words, terms, lo, hi, backward):
+		# Returns the first (or last) match starting in words <lo> to <hi>-1
+		with self._lock:
+			indexed = self.indexed
+			positions = self._positions.get(terms[0], ())
+		split = max(lo, min(hi, indexed))	# Words before this are looked up in the index, the rest are scanned
+		parts = [self._lookup(words, terms, positions, lo, split, backward), self._scan(words, terms, split, hi, backward)]
+		if backward:
+			parts.reverse()
+		for part in parts:
+			for match in part:
+				return match
+		return None
+
+	def _lookup(self, words, terms, positions, lo, hi, backward):
+		# Yields the matches starting in words <lo> to <hi>-1, found through the index
+		first = bisect_left(positions, lo)
+		last = bisect_left(positions, hi)
+		candidates = range(last-1, first-1, -1) if backward else range(first, last)
+		for i in candidates:
+			if self._matches_at(words, terms, positions[i]):
+				yield positions[i]
+
+	def _scan(self, words, terms, lo, hi, backward):
+		# Yields the matches starting in words <lo> to <hi>-1, found by going through the words one by one
+		if backward:
+			candidates = range(hi-1, lo-1, -1)
+		else:
+			candidates = range(lo, hi)
+		first = terms[0]
+		for n in candidates:
+			if term_of(words[n]) == first and self._matches_at(words, terms, n):
+				yield n
+
+	def _matches_at(self, words, terms, n):
+		# Returns whether the rest of the phrase <terms> follows word <n>, skipping words that are only punctuation or blank
+		n_words = len(words)
+		for term in terms[1:]:
+			n += 1
+			while n < n_words and not term_of(words[n]):
+				n += 1
+			if n >= n_words or term_of(words[n]) != term:
+				return False
+		return True